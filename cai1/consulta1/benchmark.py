@@ -0,0 +1,154 @@
+import os
+import time
+import logging
+import tempfile
+from utils import (
+    CHUNK_SIZE,
+    MAC_ALGORITHMS,
+    generate_nonce,
+    compute_file_hmac,
+    compute_file_hmacs,
+    compute_file_hmacs_parallel,
+    compute_file_hmacs_mapped,
+)
+
+logger = logging.getLogger(__name__)
+
+# File sizes (in MB) used when none are given
+DEFAULT_SIZES_MB = [1, 10, 100, 1000]
+
+
+def create_random_file(directory, size_bytes):
+    """Create a file of the given size filled with random data, written in chunks."""
+    fd, path = tempfile.mkstemp(dir=directory, suffix=".bin")
+    with os.fdopen(fd, "wb") as f:
+        remaining = size_bytes
+        while remaining > 0:
+            chunk_size = min(CHUNK_SIZE, remaining)
+            f.write(os.urandom(chunk_size))
+            remaining -= chunk_size
+    return path
+
+
+def precalculate_per_nonce(filepath, nonces):
+    """Previous precalculation path: one full read of the file per nonce."""
+    return [compute_file_hmac(filepath, nonce) for nonce in nonces]
+
+
+def precalculate_single_pass(filepath, nonces):
+    """Current precalculation path: one read feeding all the HMAC states."""
+    return compute_file_hmacs(filepath, nonces)
+
+
+def precalculate_parallel(filepath, nonces, workers):
+    """Parallel precalculation path: nonces split across a thread pool."""
+    return compute_file_hmacs_parallel(filepath, nonces, workers)
+
+
+def benchmark_precalculation(sizes_mb=None, num_hashes=10, directory=None, workers=1):
+    """
+    Benchmark the per-nonce and single-pass precalculation paths.
+
+    Args:
+        sizes_mb (list, optional): File sizes in MB. Defaults to DEFAULT_SIZES_MB
+        num_hashes (int): Number of precalculated hashes per file
+        directory (str, optional): Directory for the temporary files
+        workers (int): Threads for the parallel path, which is skipped when 1
+
+    Returns:
+        dict: Dictionary mapping file sizes to (per_nonce, single_pass, parallel)
+            times, with parallel set to None when it was not measured
+    """
+    if sizes_mb is None:
+        sizes_mb = DEFAULT_SIZES_MB
+
+    results = {}
+    logger.info(
+        f"Benchmarking precalculation of {num_hashes} hashes for sizes (MB): {sizes_mb}"
+    )
+
+    for size_mb in sizes_mb:
+        filepath = create_random_file(directory, int(size_mb * 1024 * 1024))
+        nonces = [generate_nonce() for _ in range(num_hashes)]
+        try:
+            start_time = time.perf_counter()
+            per_nonce = precalculate_per_nonce(filepath, nonces)
+            per_nonce_elapsed = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            single_pass = precalculate_single_pass(filepath, nonces)
+            single_pass_elapsed = time.perf_counter() - start_time
+
+            parallel = single_pass
+            parallel_elapsed = None
+            if workers > 1:
+                start_time = time.perf_counter()
+                parallel = precalculate_parallel(filepath, nonces, workers)
+                parallel_elapsed = time.perf_counter() - start_time
+        finally:
+            os.remove(filepath)
+
+        if not per_nonce == single_pass == parallel:
+            raise RuntimeError("Precalculation paths returned different hashes")
+
+        speedup = per_nonce_elapsed / single_pass_elapsed if single_pass_elapsed else 0
+        logger.info(
+            f"{size_mb:g} MB: per-nonce {per_nonce_elapsed:.4f}s, "
+            f"single-pass {single_pass_elapsed:.4f}s ({speedup:.2f}x)"
+        )
+        if parallel_elapsed is not None:
+            logger.info(
+                f"{size_mb:g} MB: parallel ({workers} workers) {parallel_elapsed:.4f}s"
+            )
+        results[size_mb] = (per_nonce_elapsed, single_pass_elapsed, parallel_elapsed)
+
+    return results
+
+
+def benchmark_macs(sizes_mb=None, directory=None, algorithms=MAC_ALGORITHMS, repeat=3):
+    """
+    Benchmark the throughput of every MAC algorithm.
+    Each file is hashed through the memory-mapped path used by the cloud,
+    once to warm the page cache and then repeat times, keeping the best run,
+    so the results measure the MAC and not the disk.
+
+    Args:
+        sizes_mb (list, optional): File sizes in MB. Defaults to DEFAULT_SIZES_MB
+        directory (str, optional): Directory for the temporary files
+        algorithms (tuple): MAC algorithms to measure
+        repeat (int): Number of timed runs per algorithm and size
+
+    Returns:
+        dict: Dictionary mapping file sizes to {algorithm: MB/s}
+    """
+    if sizes_mb is None:
+        sizes_mb = DEFAULT_SIZES_MB
+
+    results = {}
+    logger.info(f"Benchmarking MAC algorithms {list(algorithms)} for sizes (MB): {sizes_mb}")
+
+    for size_mb in sizes_mb:
+        size_bytes = int(size_mb * 1024 * 1024)
+        filepath = create_random_file(directory, size_bytes)
+        nonce = generate_nonce()
+        results[size_mb] = {}
+        try:
+            compute_file_hmacs_mapped(filepath, [nonce])
+            for algorithm in algorithms:
+                best = None
+                for _ in range(repeat):
+                    start_time = time.perf_counter()
+                    compute_file_hmacs_mapped(filepath, [nonce], algorithm=algorithm)
+                    elapsed = time.perf_counter() - start_time
+                    best = elapsed if best is None else min(best, elapsed)
+                throughput = size_bytes / (1024 * 1024) / best if best else 0.0
+                results[size_mb][algorithm] = throughput
+        finally:
+            os.remove(filepath)
+
+        logger.info(
+            f"{size_mb:g} MB: "
+            + ", ".join(f"{a} {mbps:.1f} MB/s" for a, mbps in results[size_mb].items())
+        )
+
+    return results
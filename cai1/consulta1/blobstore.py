@@ -0,0 +1,98 @@
+import os
+import shutil
+import hashlib
+import tempfile
+from utils import CHUNK_SIZE, iter_file_chunks
+
+
+def compute_blob_id(filepath):
+    """Content address of a file: the hex SHA-256 of its bytes."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter_file_chunks(f):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BlobStore:
+    """
+    Content-addressed store of file contents.
+    Every distinct content is kept once under its SHA-256, sharded into two
+    levels of subdirectories so no directory grows too large. Names are
+    mapped to blobs with hard links, so adding a duplicate is a single
+    metadata operation on disk.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path(self, blob_id):
+        """Path of a blob, sharded by the first bytes of its id."""
+        if len(blob_id) != 64 or not all(c in "0123456789abcdef" for c in blob_id):
+            raise ValueError(f"Invalid blob id: {blob_id}")
+        return os.path.join(self.root, blob_id[:2], blob_id[2:4], blob_id)
+
+    def has(self, blob_id):
+        """Whether a blob is already stored."""
+        return os.path.exists(self.path(blob_id))
+
+    def put(self, blob_id, content):
+        """
+        Store a blob given as bytes or as an open binary file.
+        The content is written to a temporary file while it is hashed and
+        only moved into place if it matches the id, so a blob is never
+        stored under the wrong address or left half written.
+        """
+        if self.has(blob_id):
+            return self.path(blob_id)
+
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if isinstance(content, (bytes, bytearray, memoryview)):
+                    digest.update(content)
+                    f.write(content)
+                else:
+                    for chunk in iter_file_chunks(content, CHUNK_SIZE):
+                        digest.update(chunk)
+                        f.write(chunk)
+            if digest.hexdigest() != blob_id:
+                raise ValueError(f"Content does not match blob id {blob_id}")
+
+            blob_path = self.path(blob_id)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(tmp_path, blob_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return blob_path
+
+    def put_file(self, blob_id, filepath):
+        """Store a blob from a file on disk, skipping the copy if it exists."""
+        if self.has(blob_id):
+            return self.path(blob_id)
+        with open(filepath, "rb") as f:
+            return self.put(blob_id, f)
+
+    def link(self, blob_id, dest):
+        """
+        Make dest a name of a stored blob, replacing any previous file.
+        Returns False if the blob is not stored.
+        """
+        blob_path = self.path(blob_id)
+        if not os.path.exists(blob_path):
+            return False
+
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_path = os.path.join(self.tmp_dir, f"link-{os.urandom(8).hex()}")
+        try:
+            os.link(blob_path, tmp_path)
+        except OSError:
+            # File systems without hard links get a copy instead
+            shutil.copyfile(blob_path, tmp_path)
+        os.replace(tmp_path, dest)
+        return True
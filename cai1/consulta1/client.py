@@ -1,36 +1,192 @@
 import os
-import json
-from utils import generate_nonce, compute_hmac, compare_digests
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from blobstore import BlobStore, compute_blob_id
+from metadata_store import open_metadata_store
+from metrics import metrics
+from replenisher import Replenisher
+from merkle import (
+    compute_file_leaves,
+    leaf_hash,
+    merkle_root,
+    read_leaves,
+    verify_path,
+    write_leaves,
+)
+from utils import (
+    walk_files,
+    percentile,
+    generate_nonce,
+    compute_block_tag,
+    blocks_for_detection,
+    sample_block_indices,
+    write_file_block_tags,
+    compute_file_hmac,
+    compute_file_hmacs_parallel,
+    compare_digests,
+    DEFAULT_MAC,
+    MAC_ALGORITHMS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ChallengesExhaustedError(Exception):
+    """Raised when a file has no precalculated challenge left and no local copy."""
+
+
+# Errors that make a single file unverifiable without stopping a sweep. A
+# remote cloud raises RuntimeError for server-side errors and ConnectionError
+# when the connection drops.
+CHALLENGE_ERRORS = (
+    FileNotFoundError,
+    ValueError,
+    ChallengesExhaustedError,
+    RuntimeError,
+    ConnectionError,
+)
+
+# Errors that make a single file fail to upload without stopping a bulk
+# upload: unreadable files (OSError, which includes ConnectionError) and
+# errors returned by a remote cloud.
+INGEST_ERRORS = (OSError, ValueError, RuntimeError)
 
 
 class Client:
     def __init__(
-        self, storage_dir="client_storage", num_nonces=5, num_precalculated_hashes=10
+        self,
+        storage_dir="client_storage",
+        num_nonces=5,
+        num_precalculated_hashes=10,
+        workers=1,
+        metadata_backend="json",
+        cloud_address=None,
+        block_size=None,
+        detection_probability=0.99,
+        corruption_fraction=0.01,
+        merkle_chunk_size=None,
+        low_water_mark=None,
+        replenish_batch=None,
+        replenish_bandwidth=None,
+        dedup=False,
+        keep_local_copy=True,
+        mac_algorithm=DEFAULT_MAC,
     ):
         """Initialize the client with a storage directory and generate predefined nonces."""
         self.storage_dir = storage_dir
         os.makedirs(storage_dir, exist_ok=True)
-        self.metadata_file = os.path.join(storage_dir, "metadata.json")
+        self.store = open_metadata_store(storage_dir, metadata_backend)
         self.metadata = self._load_metadata()
 
         # Generate predefined nonces for challenges
         self.nonces = [generate_nonce() for _ in range(num_nonces)]
         self.current_nonce_index = 0
+        self._lock = threading.Lock()
 
         # Number of precalculated hashes to generate for each file
         self.num_precalculated_hashes = num_precalculated_hashes
 
-    def _load_metadata(self):
-        """Load metadata from file if it exists."""
-        if os.path.exists(self.metadata_file):
-            with open(self.metadata_file, "r") as f:
-                return json.load(f)
-        return {}
+        # Number of threads used to compute the precalculated hashes
+        self.workers = workers
+        self.failed_files = {}
+
+        # Address of a remote cloud server, or None to use the in-process cloud
+        self.cloud_address = cloud_address
+        self._cloud = None
+
+        # Block mode: files are verified by sampling tagged blocks instead of
+        # hashing them whole. Enough blocks are sampled to detect the loss of
+        # corruption_fraction of the file with detection_probability.
+        if not 0 < detection_probability < 1:
+            raise ValueError("The detection probability must be between 0 and 1")
+        if not 0 < corruption_fraction <= 1:
+            raise ValueError("The corruption fraction must be above 0 and at most 1")
+        self.block_size = block_size
+        self.detection_probability = detection_probability
+        self.corruption_fraction = corruption_fraction
+
+        # Merkle mode: files are committed to with a Merkle tree over chunks of
+        # this size, which supports incremental updates and O(log n) proofs
+        if block_size and merkle_chunk_size:
+            raise ValueError("Block mode and Merkle mode cannot be combined")
+        self.merkle_chunk_size = merkle_chunk_size
+
+        # Deduplicating mode: contents are stored once under their SHA-256 and
+        # files with the same content share a single pool of challenges
+        if dedup and (block_size or merkle_chunk_size):
+            raise ValueError("Deduplication only supports whole-file challenges")
+        # MAC algorithm of the challenges of new files, recorded per file
+        if mac_algorithm not in MAC_ALGORITHMS:
+            raise ValueError(f"Unknown MAC algorithm: {mac_algorithm}")
+        self.mac_algorithm = mac_algorithm
+
+        self.blobs = None
+        self._blob_owners = {}
+        if dedup:
+            self.blobs = BlobStore(os.path.join(storage_dir, ".blobs"))
+            for filename, entry in self.metadata.items():
+                if "blob" in entry and "alias_of" not in entry:
+                    key = (entry["blob"], entry.get("mac", DEFAULT_MAC))
+                    self._blob_owners[key] = filename
+
+        # Without local copies only the precalculated challenges (or the
+        # Merkle roots) are kept, so exhausted files cannot be rehashed
+        if not keep_local_copy and low_water_mark:
+            raise ValueError("Replenishing challenges requires local copies")
+        self.keep_local_copy = keep_local_copy
+
+        # Depth of the challenge pools, computed only when metrics are exported
+        metrics.register_gauge("challenge_pool_unused", self._unused_challenges)
+        metrics.register_gauge(
+            "challenge_pool_min", lambda: min(self._pool_depths(), default=0)
+        )
+
+        # Refill the precalculated hashes in the background when a file has
+        # fewer than low_water_mark unused ones left
+        self.replenisher = None
+        if low_water_mark:
+            self.replenisher = Replenisher(
+                self,
+                low_water_mark,
+                replenish_batch or num_precalculated_hashes,
+                replenish_bandwidth,
+            )
+            self.replenisher.start()
 
-    def _save_metadata(self):
-        """Save metadata to file."""
-        with open(self.metadata_file, "w") as f:
-            json.dump(self.metadata, f)
+    def _load_metadata(self):
+        """Load metadata from the configured metadata backend."""
+        return self.store.load()
+
+    def _save_metadata(self, entries):
+        """Persist the metadata entries of the given files."""
+        with metrics.timer("metadata_save"):
+            self.store.put_files(entries)
+
+    def _get_cloud(self):
+        """Return the cloud used by this client, connecting to it on first use."""
+        if self._cloud is None:
+            if self.cloud_address:
+                from transport import RemoteCloud
+
+                self._cloud = RemoteCloud(self.cloud_address)
+            else:
+                from cloud import Cloud
+
+                self._cloud = Cloud()
+        return self._cloud
+
+    def close(self):
+        """Close the connection to the cloud and the metadata store."""
+        if self.replenisher is not None:
+            self.replenisher.stop()
+        if self._cloud is not None and hasattr(self._cloud, "close"):
+            self._cloud.close()
+        self._cloud = None
+        self.store.close()
 
     def get_next_nonce(self):
         """Get the next predefined nonce in the sequence."""
@@ -38,58 +194,375 @@ class Client:
         self.current_nonce_index = (self.current_nonce_index + 1) % len(self.nonces)
         return nonce
 
-    def process_file(self, filepath):
+    def _ingest_file(self, filepath, filename, cloud, workers):
         """
-        Process a file according to the integrity verification process.
-        1. Generate a nonce
-        2. Compute HMAC of the file using the nonce
-        3. Store the file and hash locally
-        4. Precalculate additional hashes with different nonces
-        5. Upload the file to the cloud (mock)
+        Hash, store locally and upload a single file.
+        Returns the metadata entry for the file without saving it, so callers
+        can decide when the metadata is written to disk.
         """
-        filename = os.path.basename(filepath)
-
-        # 1. Read the file content
-        with open(filepath, "rb") as f:
-            file_content = f.read()
-
-        # 2. Generate a nonce
-        nonce = self.get_next_nonce()
-
-        # 3. Compute HMAC of the file using the nonce
-        file_hash = compute_hmac(file_content, nonce)
-
-        # 4. Store the file locally
-        local_filepath = os.path.join(self.storage_dir, filename)
-        with open(local_filepath, "wb") as f:
-            f.write(file_content)
-
-        # 5. Precalculate additional hashes with different nonces
-        precalculated_hashes = {}
-        for _ in range(self.num_precalculated_hashes):
-            precalc_nonce = generate_nonce()
-            precalc_hash = compute_hmac(file_content, precalc_nonce)
-            precalculated_hashes[precalc_nonce.hex()] = precalc_hash.hex()
+        if self.blobs is not None:
+            return self._ingest_blob(filepath, filename, cloud, workers)
+
+        # 1. Hash the file (block tags in block mode, a Merkle tree in Merkle
+        #    mode and whole-file HMACs otherwise)
+        with metrics.timer("read_hash"):
+            if self.block_size:
+                entry = self._tag_blocks(filepath, filename, cloud)
+            elif self.merkle_chunk_size:
+                entry = self._commit_merkle(filepath, filename)
+            else:
+                entry = self._precalculate_hashes(filepath, workers)
+
+        # 2. Store the file locally, unless running without local copies
+        local_filepath = None
+        if self.keep_local_copy:
+            with metrics.timer("store_local"):
+                local_filepath = os.path.join(self.storage_dir, filename)
+                os.makedirs(os.path.dirname(local_filepath), exist_ok=True)
+                shutil.copyfile(filepath, local_filepath)
+
+        # 3. "Upload" to cloud (mock by calling the cloud module)
+        with metrics.timer("upload"):
+            with open(filepath, "rb") as f:
+                cloud.upload_file(filename, f)
+            if self.merkle_chunk_size:
+                cloud.build_merkle_tree(filename, self.merkle_chunk_size)
+
+        size = os.path.getsize(filepath)
+        metrics.inc("files_processed")
+        metrics.inc("bytes_processed", size)
+        return {
+            "original_path": filepath,
+            "local_path": local_filepath,
+            "size": size,
+            **entry,
+        }
 
-        # 6. Store metadata (including hash, nonce, and precalculated hashes)
-        self.metadata[filename] = {
+    def _ingest_blob(self, filepath, filename, cloud, workers):
+        """
+        Hash, store locally and upload a single file by content address.
+        1. Compute the SHA-256 of the file, its blob id
+        2. If another file has the same content, share its challenges
+           instead of hashing the file again
+        3. Store the content locally once per blob id
+        4. Link the file to the blob in the cloud, uploading the content
+           only if the cloud does not have it yet
+        """
+        # 1. Address the content
+        with metrics.timer("content_address"):
+            blob_id = compute_blob_id(filepath)
+
+        # 2. Reuse the challenges of a file with the same content and MAC. The
+        #    owner may still be in flight in the same batch, so the alias is
+        #    only resolved when a challenge is issued
+        with self._lock:
+            previous = self.metadata.get(filename, {})
+            previous_key = (previous.get("blob"), previous.get("mac", DEFAULT_MAC))
+            if self._blob_owners.get(previous_key) == filename:
+                del self._blob_owners[previous_key]
+            owner = self._blob_owners.setdefault(
+                (blob_id, self.mac_algorithm), filename
+            )
+        if owner != filename:
+            logger.info(f"🔗 {filename} has the same content as {owner}.")
+            entry = {
+                "nonce": None,
+                "hash": None,
+                "precalculated_hashes": [],
+                "used_count": 0,
+                "mac": self.mac_algorithm,
+                "alias_of": owner,
+            }
+        else:
+            with metrics.timer("read_hash"):
+                entry = self._precalculate_hashes(filepath, workers)
+
+        # 3. Store the content locally, unless running without local copies
+        local_filepath = None
+        if self.keep_local_copy:
+            with metrics.timer("store_local"):
+                local_filepath = self.blobs.put_file(blob_id, filepath)
+
+        # 4. "Upload" to cloud, as a link when the content is already there
+        with metrics.timer("upload"):
+            if not cloud.link_blob(filename, blob_id):
+                with open(filepath, "rb") as f:
+                    cloud.upload_blob(blob_id, f)
+                cloud.link_blob(filename, blob_id)
+
+        size = os.path.getsize(filepath)
+        metrics.inc("files_processed")
+        metrics.inc("bytes_processed", size)
+        return {
             "original_path": filepath,
             "local_path": local_filepath,
+            "size": size,
+            "blob": blob_id,
+            **entry,
+        }
+
+    def _challenge_pool(self, filename):
+        """
+        Name of the file whose precalculated challenges are used for a file.
+        Files with duplicated content use the challenges of the first file
+        stored with that content, as long as it still has the same content
+        and MAC algorithm.
+        """
+        entry = self.metadata.get(filename, {})
+        owner = entry.get("alias_of")
+        owner_entry = self.metadata.get(owner, {})
+        if (
+            owner
+            and owner_entry.get("blob") == entry.get("blob")
+            and self._file_mac(owner) == self._file_mac(filename)
+        ):
+            return owner
+        return filename
+
+    def _pool_depths(self):
+        """Unused precalculated challenges of every file that owns a pool."""
+        return [
+            self.store.unused_count(filename)
+            for filename, entry in list(self.metadata.items())
+            if not {"block_size", "merkle_root", "alias_of"} & entry.keys()
+        ]
+
+    def _unused_challenges(self):
+        """Total number of unused precalculated challenges."""
+        return sum(self._pool_depths())
+
+    def _file_mac(self, filename):
+        """MAC algorithm of the challenges of a stored file."""
+        return self.metadata.get(filename, {}).get("mac", DEFAULT_MAC)
+
+    def _precalculate_hashes(self, filepath, workers):
+        """Compute the whole-file hash and the precalculated challenges of a file."""
+        # 1. Generate the challenge nonce and the precalculated nonces
+        with self._lock:
+            nonce = self.get_next_nonce()
+        precalc_nonces = [
+            generate_nonce() for _ in range(self.num_precalculated_hashes)
+        ]
+
+        # 2. Compute every HMAC streaming the file once per worker
+        file_hash, *precalc_hashes = compute_file_hmacs_parallel(
+            filepath, [nonce] + precalc_nonces, workers, algorithm=self.mac_algorithm
+        )
+        precalculated_hashes = [
+            [n.hex(), h.hex()] for n, h in zip(precalc_nonces, precalc_hashes)
+        ]
+
+        return {
             "nonce": nonce.hex(),
             "hash": file_hash.hex(),
             "precalculated_hashes": precalculated_hashes,
-            "used_hashes": [],  # Track which precalculated hashes have been used
+            "used_count": 0,  # Number of precalculated hashes already consumed
+            "mac": self.mac_algorithm,
         }
-        self._save_metadata()
 
-        # 7. "Upload" to cloud (mock by calling the cloud module)
-        from cloud import Cloud
+    def _tag_blocks(self, filepath, filename, cloud):
+        """
+        Compute the block tags of a file and upload them to the cloud.
+        Only the tag nonce and the block layout are kept locally, so the
+        client state does not grow with the size of the file.
+        """
+        tag_nonce = generate_nonce()
+        with tempfile.TemporaryFile() as tags:
+            num_blocks = write_file_block_tags(
+                filepath, tag_nonce, self.block_size, tags, self.mac_algorithm
+            )
+            tags.seek(0)
+            cloud.upload_block_tags(filename, tags)
+
+        return {
+            "nonce": None,
+            "hash": None,
+            "precalculated_hashes": [],
+            "used_count": 0,
+            "mac": self.mac_algorithm,
+            "block_size": self.block_size,
+            "num_blocks": num_blocks,
+            "tag_nonce": tag_nonce.hex(),
+        }
+
+    def _leaves_path(self, filename):
+        """Path of the local copy of the Merkle leaves of a file."""
+        return os.path.join(self.storage_dir, ".merkle", filename)
 
-        cloud = Cloud()
-        cloud.upload_file(filename, file_content)
+    def _commit_merkle(self, filepath, filename, leaves=None):
+        """
+        Commit to a file with a Merkle tree over fixed-size chunks.
+        The metadata only keeps the root and the tree shape. The leaf hashes
+        are kept in a compact binary side file so later updates only rehash
+        the chunks that changed.
+        """
+        chunk_size = self.merkle_chunk_size
+        if leaves is None:
+            leaves = compute_file_leaves(filepath, chunk_size)
+
+        leaves_path = self._leaves_path(filename)
+        os.makedirs(os.path.dirname(leaves_path), exist_ok=True)
+        with open(leaves_path, "wb") as f:
+            write_leaves(f, leaves)
+
+        return {
+            "nonce": None,
+            "hash": None,
+            "precalculated_hashes": [],
+            "used_count": 0,
+            "merkle_chunk_size": chunk_size,
+            "num_leaves": len(leaves),
+            "merkle_root": merkle_root(leaves).hex(),
+        }
+
+    def update_file(self, filepath, changed_ranges=None):
+        """
+        Propagate a change of a file committed in Merkle mode.
+        1. Find the chunks to rehash: the ones overlapping changed_ranges
+           (a list of (offset, length) pairs) plus any chunk affected by a
+           change of size, or every chunk when no ranges are given
+        2. Rehash only those chunks and keep the ones whose leaf changed
+        3. Recompute the root from the stored leaves
+        4. Send only the changed chunks to the cloud and the local copy
+        """
+        filename = os.path.basename(filepath)
+        file_metadata = self.metadata.get(filename)
+        if file_metadata is None or "merkle_root" not in file_metadata:
+            raise ValueError(f"File {filename} is not stored in Merkle mode")
+
+        chunk_size = file_metadata["merkle_chunk_size"]
+        with open(self._leaves_path(filename), "rb") as f:
+            leaves = read_leaves(f)
+
+        # 1. Find the chunks that may have changed
+        old_size = file_metadata["size"]
+        new_size = os.path.getsize(filepath)
+        num_leaves = -(-new_size // chunk_size)
+        if changed_ranges is None:
+            indices = set(range(num_leaves))
+        else:
+            indices = set()
+            for offset, length in changed_ranges:
+                last = (offset + max(length, 1) - 1) // chunk_size
+                indices.update(range(offset // chunk_size, last + 1))
+            if new_size != old_size:
+                indices.update(range(min(old_size, new_size) // chunk_size, num_leaves))
+        indices = sorted(i for i in indices if i < num_leaves)
+
+        # 2. Rehash those chunks and keep the ones that actually changed
+        leaves = leaves[:num_leaves]
+        leaves += [None] * (num_leaves - len(leaves))
+        changed = {}
+        with open(filepath, "rb") as f:
+            for index in indices:
+                f.seek(index * chunk_size)
+                chunk = f.read(chunk_size)
+                leaf = leaf_hash(chunk)
+                if leaf != leaves[index]:
+                    leaves[index] = leaf
+                    changed[index] = chunk
+
+        # 3. Recompute the root and store the new leaves
+        entry = {**file_metadata, **self._commit_merkle(filepath, filename, leaves)}
+        entry["size"] = new_size
+
+        # 4. Send the changed chunks to the cloud and the local copy
+        self._get_cloud().write_chunks(filename, chunk_size, changed, new_size)
+        if file_metadata["local_path"] is not None:
+            with open(file_metadata["local_path"], "r+b") as f:
+                for index, chunk in changed.items():
+                    f.seek(index * chunk_size)
+                    f.write(chunk)
+                f.truncate(new_size)
+
+        self._save_metadata({filename: entry})
+        logger.info(
+            f"🌳 Updated {len(changed)} of {num_leaves} chunks of {filename}."
+        )
+        return sorted(changed)
+
+    def process_file(self, filepath):
+        """
+        Process a file according to the integrity verification process.
+        1. Generate a nonce and the nonces for the precalculated hashes
+        2. Compute all the HMACs of the file in a single read pass (or in
+           parallel across the configured workers)
+        3. Store the file and hash locally
+        4. Upload the file to the cloud (mock)
+        5. Store the metadata with the precalculated hashes
+        """
+        filename = os.path.basename(filepath)
+        with metrics.timer("process_file"):
+            entry = self._ingest_file(
+                filepath, filename, self._get_cloud(), self.workers
+            )
+            self._save_metadata({filename: entry})
 
         return filename
 
+    def process_files(self, paths, root=None, concurrency=None, checkpoint_every=1000):
+        """
+        Process many files through the client's cloud connection.
+        Files are hashed and uploaded concurrently, each one in a single read
+        pass, and the metadata is written every checkpoint_every files and
+        once at the end instead of after every file.
+        When root is given, files are named by their path relative to it so
+        that files with the same name in different directories do not collide.
+        A file that fails is skipped and its error is recorded in
+        self.failed_files. Returns the names of the processed files.
+        """
+        cloud = self._get_cloud()
+        concurrency = concurrency or self.workers
+        max_in_flight = concurrency * 4
+        processed = []
+        pending = {}
+        batch = {}
+        self.failed_files = {}
+
+        def submit(executor, filepath):
+            if root is None:
+                filename = os.path.basename(filepath)
+            else:
+                filename = os.path.relpath(filepath, root).replace(os.sep, "/")
+            future = executor.submit(self._ingest_file, filepath, filename, cloud, 1)
+            pending[future] = filename
+
+        def collect(done):
+            for future in done:
+                filename = pending.pop(future)
+                try:
+                    batch[filename] = future.result()
+                except INGEST_ERRORS as e:
+                    self.failed_files[filename] = str(e)
+                    continue
+                processed.append(filename)
+                if checkpoint_every and len(batch) >= checkpoint_every:
+                    self._save_metadata(batch)
+                    batch.clear()
+
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for filepath in paths:
+                    # Bound the number of queued files so huge trees stream through
+                    if len(pending) >= max_in_flight:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    submit(executor, filepath)
+                collect(wait(pending).done)
+        finally:
+            # Files already uploaded keep their metadata even if the run stops
+            self._save_metadata(batch)
+        return processed
+
+    def process_directory(self, directory, concurrency=None, checkpoint_every=1000):
+        """Process every file found walking a directory tree."""
+        return self.process_files(
+            walk_files(directory),
+            root=directory,
+            concurrency=concurrency,
+            checkpoint_every=checkpoint_every,
+        )
+
     def verify_file_integrity(self, filename):
         """
         Verify the integrity of a file by:
@@ -98,65 +571,246 @@ class Client:
         3. If no, generate a new nonce for the challenge and compute the hash
         4. Comparing the local hash with the one received from the cloud
         """
-        import logging
-
-        logger = logging.getLogger(__name__)
+        with metrics.timer("verify"):
+            result = self._challenge_file(filename, self._get_cloud())
+        metrics.inc("verifications_passed" if result else "verifications_failed")
+        return result
 
+    def _next_challenge(self, filename, defer=False):
+        """
+        Choose the nonce of the next challenge for a file and its expected hash.
+        1. Use the next unused precalculated hash if there is one
+        2. If not, generate a fresh nonce and hash the local copy, or raise
+           ChallengesExhaustedError when there is no local copy
+        With defer=True the consumed challenge is persisted on the next flush
+        of the metadata store instead of immediately.
+        """
         if filename not in self.metadata:
             raise ValueError(f"File {filename} not found in metadata")
 
         file_metadata = self.metadata[filename]
-        from cloud import Cloud
-
-        cloud = Cloud()
 
-        # Check if we have unused precalculated hashes
-        precalculated = file_metadata.get("precalculated_hashes", {})
-        used_hashes = file_metadata.get("used_hashes", [])
+        # Claim the next unused precalculated hash
+        pool = self._challenge_pool(filename)
+        with metrics.timer("claim"):
+            claimed = self.store.claim_challenge(pool, defer=defer)
 
-        # Find an unused precalculated hash
-        available_nonces = [n for n in precalculated.keys() if n not in used_hashes]
-
-        if available_nonces:
+        if claimed:
             # 1. Use a precalculated hash
-            challenge_nonce_hex = available_nonces[0]
-            challenge_nonce = bytes.fromhex(challenge_nonce_hex)
-            local_hash_hex = precalculated[challenge_nonce_hex]
-            local_hash = bytes.fromhex(local_hash_hex)
-
-            # Mark this hash as used
-            used_hashes.append(challenge_nonce_hex)
-            file_metadata["used_hashes"] = used_hashes
-            self._save_metadata()
+            challenge_nonce_hex, local_hash_hex = claimed
 
             # Log that we're using a precalculated hash
-            remaining = len(available_nonces) - 1
+            remaining = self.store.unused_count(pool)
             logger.info(
                 f"🔄 Using precalculated hash for {filename}. {remaining} unused hashes remaining."
             )
-
-            # Send the challenge to the cloud
-            cloud_hash = cloud.challenge(filename, challenge_nonce)
-
-            # Compare the hashes
-            return compare_digests(local_hash, cloud_hash)
+            if self.replenisher is not None:
+                self.replenisher.check(pool)
+
+            metrics.inc("challenges_precalculated")
+            return bytes.fromhex(challenge_nonce_hex), bytes.fromhex(local_hash_hex)
+        elif file_metadata.get("local_path") is None:
+            # 2. Without a local copy a new hash cannot be computed
+            raise ChallengesExhaustedError(
+                f"No precalculated challenges left for {filename} and no local copy"
+            )
         else:
             # 2. No precalculated hashes available, generate a new nonce
             logger.info(
                 f"⚠️ No precalculated hashes available for {filename}. Computing new hash."
             )
 
-            challenge_nonce = self.get_next_nonce()
+            if self.replenisher is not None:
+                self.replenisher.check(pool)
 
-            # Send the challenge to the cloud
-            cloud_hash = cloud.challenge(filename, challenge_nonce)
+            # A fresh random nonce, so exhausted files never repeat a challenge
+            challenge_nonce = generate_nonce()
 
             # Compute the hash locally
-            local_filepath = file_metadata["local_path"]
-            with open(local_filepath, "rb") as f:
-                file_content = f.read()
+            with metrics.timer("local_hash"):
+                local_hash = compute_file_hmac(
+                    file_metadata["local_path"],
+                    challenge_nonce,
+                    algorithm=self._file_mac(filename),
+                )
+            metrics.inc("challenges_fallback")
+            return challenge_nonce, local_hash
+
+    def _challenge_blocks(self, filename, cloud):
+        """
+        Verify a file stored in block mode:
+        1. Derive a random subset of block indices from a fresh nonce
+        2. Ask the cloud for those blocks and their tags
+        3. Recompute the tag of every returned block with the secret key
+        """
+        file_metadata = self.metadata[filename]
+        num_blocks = file_metadata["num_blocks"]
+        count = blocks_for_detection(
+            num_blocks, self.detection_probability, self.corruption_fraction
+        )
+        indices = sample_block_indices(generate_nonce(), num_blocks, count)
+        logger.info(f"🧩 Sampling {count} of {num_blocks} blocks of {filename}.")
+
+        with metrics.timer("cloud_challenge"):
+            blocks = cloud.challenge_blocks(
+                filename, file_metadata["block_size"], indices
+            )
+
+        tag_nonce = bytes.fromhex(file_metadata["tag_nonce"])
+        mac = self._file_mac(filename)
+        valid = len(blocks) == len(indices)
+        for index, (block, tag) in zip(indices, blocks):
+            expected_tag = compute_block_tag(tag_nonce, index, block, mac)
+            valid = compare_digests(expected_tag, tag) and valid
+        return valid
+
+    def _challenge_merkle(self, filename, cloud):
+        """
+        Verify a file stored in Merkle mode:
+        1. Pick a random chunk from a fresh nonce
+        2. Ask the cloud for that chunk and its authentication path
+        3. Recompute the root from the chunk and the path in O(log n)
+        """
+        file_metadata = self.metadata[filename]
+        num_leaves = file_metadata["num_leaves"]
+        if num_leaves == 0:
+            return True
+
+        chunk_size = file_metadata["merkle_chunk_size"]
+        (index,) = sample_block_indices(generate_nonce(), num_leaves, 1)
+        logger.info(f"🌳 Requesting chunk {index} of {num_leaves} of {filename}.")
+
+        with metrics.timer("cloud_challenge"):
+            chunk, path = cloud.challenge_merkle(filename, chunk_size, index)
+
+        expected_length = min(chunk_size, file_metadata["size"] - index * chunk_size)
+        return len(chunk) == expected_length and verify_path(
+            bytes.fromhex(file_metadata["merkle_root"]),
+            num_leaves,
+            index,
+            leaf_hash(chunk),
+            path,
+        )
+
+    def _challenge_file(self, filename, cloud, defer=False):
+        """Challenge the cloud for a single file and compare the response."""
+        if "block_size" in self.metadata.get(filename, {}):
+            return self._challenge_blocks(filename, cloud)
+        if "merkle_root" in self.metadata.get(filename, {}):
+            return self._challenge_merkle(filename, cloud)
+
+        challenge_nonce, local_hash = self._next_challenge(filename, defer)
+
+        # Send the challenge to the cloud
+        with metrics.timer("cloud_challenge"):
+            cloud_hash = cloud.challenge(
+                filename, challenge_nonce, self._file_mac(filename)
+            )
 
-            local_hash = compute_hmac(file_content, challenge_nonce)
+        # Compare the hashes
+        return compare_digests(local_hash, cloud_hash)
 
-            # Compare the hashes
-            return compare_digests(local_hash, cloud_hash)
+    def _challenge_batch(self, filenames, cloud):
+        """
+        Challenge the cloud for several files with a single batched request.
+        Returns a dict mapping each filename to the verification result, or to
+        the exception raised when the file could not be challenged.
+        """
+        results = {}
+        challenges = []
+        for filename in filenames:
+            try:
+                file_metadata = self.metadata.get(filename, {})
+                if "block_size" in file_metadata or "merkle_root" in file_metadata:
+                    # Block and Merkle challenges read few chunks, so they are
+                    # not batched
+                    results[filename] = self._challenge_file(filename, cloud)
+                else:
+                    challenges.append(
+                        (filename, *self._next_challenge(filename, True))
+                    )
+            except CHALLENGE_ERRORS as e:
+                results[filename] = e
+
+        try:
+            with metrics.timer("cloud_challenge_batch"):
+                cloud_hashes = cloud.challenge_batch(
+                    [
+                        (filename, nonce, self._file_mac(filename))
+                        for filename, nonce, _ in challenges
+                    ]
+                )
+        except CHALLENGE_ERRORS as e:
+            # The whole request failed, so none of its files could be checked
+            for filename, _, _ in challenges:
+                results[filename] = e
+            return results
+        for (filename, _, local_hash), cloud_hash in zip(challenges, cloud_hashes):
+            if cloud_hash is None:
+                results[filename] = FileNotFoundError(
+                    f"File {filename} not found in cloud storage"
+                )
+            else:
+                results[filename] = compare_digests(local_hash, cloud_hash)
+        return results
+
+    def verify_all(self, concurrency=8, batch_size=None):
+        """
+        Verify the integrity of every file in the metadata.
+        Challenges are issued concurrently through the client's cloud (with a
+        remote cloud they are pipelined over its connection pool) and the
+        consumed challenges are persisted once at the end of the sweep.
+        With batch_size set, files are challenged in batches of that size with
+        one request per batch, and every file of a batch gets its latency.
+        Returns a summary report with pass/fail counts, throughput and latency.
+        """
+        cloud = self._get_cloud()
+        filenames = list(self.metadata)
+        failures = []
+        errors = {}
+        latencies = []
+        total_bytes = 0
+
+        size = batch_size or 1
+        batches = [filenames[i : i + size] for i in range(0, len(filenames), size)]
+
+        def verify(batch):
+            start_time = time.perf_counter()
+            if batch_size:
+                results = self._challenge_batch(batch, cloud)
+            else:
+                try:
+                    results = {batch[0]: self._challenge_file(batch[0], cloud, True)}
+                except CHALLENGE_ERRORS as e:
+                    results = {batch[0]: e}
+            return results, time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for results, latency in executor.map(verify, batches):
+                    for filename, result in results.items():
+                        latencies.append(latency)
+                        total_bytes += self.metadata[filename].get("size", 0)
+                        if isinstance(result, Exception):
+                            errors[filename] = str(result)
+                        elif not result:
+                            failures.append(filename)
+        finally:
+            self.store.flush()
+        elapsed = time.perf_counter() - start_time
+
+        passed = len(filenames) - len(failures) - len(errors)
+        return {
+            "files": len(filenames),
+            "passed": passed,
+            "failed": len(failures),
+            "errors": len(errors),
+            "failed_files": failures,
+            "error_files": errors,
+            "elapsed": elapsed,
+            "files_per_second": len(filenames) / elapsed if elapsed else 0.0,
+            "bytes_per_second": total_bytes / elapsed if elapsed else 0.0,
+            "p50_latency": percentile(latencies, 50),
+            "p99_latency": percentile(latencies, 99),
+        }
@@ -1,46 +1,348 @@
 import os
-from utils import compute_hmac
+import struct
+import shutil
+import threading
+from collections import OrderedDict
+from blobstore import BlobStore
+from metrics import metrics
+from merkle import (
+    auth_path,
+    build_levels,
+    compute_file_leaves,
+    leaf_hash,
+    read_leaves,
+    write_leaves,
+)
+from utils import BLOCK_TAG_SIZE, DEFAULT_MAC, compute_file_hmacs_mapped
+
+# Header of the Merkle leaves files: chunk size and the mtime and size of the
+# stored file the leaves were computed from
+MERKLE_HEADER = struct.Struct(">IQQ")
+
+# Number of challenge responses kept in the response cache by default
+RESPONSE_CACHE_SIZE = 1024
 
 
 class Cloud:
-    def __init__(self, storage_dir="cloud_storage"):
+    def __init__(self, storage_dir="cloud_storage", cache_size=RESPONSE_CACHE_SIZE):
         """Initialize the cloud with a storage directory."""
         self.storage_dir = storage_dir
         os.makedirs(storage_dir, exist_ok=True)
+        self.tags_dir = os.path.join(storage_dir, ".tags")
+        self.merkle_dir = os.path.join(storage_dir, ".merkle")
+        self.blobs = BlobStore(os.path.join(storage_dir, ".blobs"))
+        self._merkle_levels = {}  # Cached Merkle trees by filename
         self.stored_challenges = {}  # For simulating replay attacks
 
+        # LRU cache of challenge responses, so a retried nonce is not rehashed
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._responses = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def _response_key(self, filename, stat, nonce, mac):
+        """
+        Key of a challenge response in the cache.
+        It includes the version of the stored file (inode, size and
+        modification time), so any change to the file misses the cache.
+        """
+        return (filename, stat.st_ino, stat.st_size, stat.st_mtime_ns, nonce, mac)
+
+    def _cached_response(self, key):
+        """Return a cached response and mark it as recently used, or None."""
+        with self._cache_lock:
+            response = self._responses.get(key)
+            if response is None:
+                self.cache_misses += 1
+                metrics.inc("cloud_cache_misses")
+                return None
+            self.cache_hits += 1
+            metrics.inc("cloud_cache_hits")
+            self._responses.move_to_end(key)
+            return response
+
+    def _cache_response(self, key, response):
+        """Add a response to the cache, evicting the least recently used one."""
+        if not self.cache_size:
+            return
+        with self._cache_lock:
+            self._responses[key] = response
+            self._responses.move_to_end(key)
+            while len(self._responses) > self.cache_size:
+                self._responses.popitem(last=False)
+
+    def _forget_responses(self, filename):
+        """Drop the cached responses of a file that is being rewritten."""
+        with self._cache_lock:
+            for key in [k for k in self._responses if k[0] == filename]:
+                del self._responses[key]
+
+    def cache_stats(self):
+        """Hit and miss counters of the response cache."""
+        with self._cache_lock:
+            return {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "size": len(self._responses),
+            }
+
+    def _write(self, filepath, content):
+        """Write bytes or the contents of an open binary file to a path."""
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        if os.path.exists(filepath):
+            # The path may be a hard link to a shared blob, never write through it
+            os.remove(filepath)
+        with open(filepath, "wb") as f:
+            if isinstance(content, (bytes, bytearray, memoryview)):
+                f.write(content)
+            else:
+                shutil.copyfileobj(content, f)
+
     def upload_file(self, filename, content):
         """
         Simulate uploading a file to the cloud.
+        The content can be a bytes object or an open binary file, which is
+        copied in chunks so large uploads are never held fully in memory.
         """
+        self._forget_responses(filename)
         filepath = os.path.join(self.storage_dir, filename)
-        with open(filepath, "wb") as f:
-            f.write(content)
+        with metrics.timer("cloud_upload"):
+            self._write(filepath, content)
+        if metrics.enabled:
+            metrics.inc("cloud_bytes_uploaded", os.path.getsize(filepath))
         return True
 
-    def challenge(self, filename, nonce):
+    def upload_blob(self, blob_id, content):
         """
-        Respond to an integrity challenge by:
-        1. Retrieving the file
-        2. Computing the HMAC with the provided nonce
-        3. Returning the hash
+        Store a content-addressed blob given as bytes or an open binary file.
+        The cloud checks that the content matches its SHA-256 id.
+        """
+        self.blobs.put(blob_id, content)
+        return True
+
+    def link_blob(self, filename, blob_id):
+        """
+        Store a file as a name of an already stored blob.
+        Duplicate uploads become a single hard link, with no data transfer.
+        Returns False if the blob is not stored yet.
+        """
+        self._forget_responses(filename)
+        return self.blobs.link(blob_id, os.path.join(self.storage_dir, filename))
+
+    def upload_block_tags(self, filename, content):
+        """
+        Store the block tags of a file, used to answer block challenges.
+        The tags are computed by the client with its secret key, so the cloud
+        can return them but cannot forge them.
+        """
+        self._write(os.path.join(self.tags_dir, filename), content)
+        return True
+
+    def challenge_blocks(self, filename, block_size, indices):
+        """
+        Respond to a block challenge by reading only the requested blocks.
+        Returns a (block, tag) pair for every index, in the requested order.
         """
         filepath = os.path.join(self.storage_dir, filename)
+        tags_path = os.path.join(self.tags_dir, filename)
 
+        if not os.path.exists(filepath) or not os.path.exists(tags_path):
+            raise FileNotFoundError(f"File {filename} not found in cloud storage")
+
+        blocks = []
+        with open(filepath, "rb") as f, open(tags_path, "rb") as tags:
+            for index in indices:
+                f.seek(index * block_size)
+                tags.seek(index * BLOCK_TAG_SIZE)
+                blocks.append((f.read(block_size), tags.read(BLOCK_TAG_SIZE)))
+        return blocks
+
+    def _save_leaves(self, filename, chunk_size, leaves):
+        """Store the Merkle leaves of a file, stamped with the file's mtime and size."""
+        stat = os.stat(os.path.join(self.storage_dir, filename))
+        leaves_path = os.path.join(self.merkle_dir, filename)
+        os.makedirs(os.path.dirname(leaves_path), exist_ok=True)
+        with open(leaves_path, "wb") as f:
+            f.write(MERKLE_HEADER.pack(chunk_size, stat.st_mtime_ns, stat.st_size))
+            write_leaves(f, leaves)
+        self._merkle_levels.pop(filename, None)
+
+    def _load_leaves(self, filename, chunk_size, check_fresh=True):
+        """
+        Load the stored Merkle leaves of a file, or None if there are none.
+        With check_fresh, leaves computed for another version of the file or
+        another chunk size are discarded.
+        """
+        leaves_path = os.path.join(self.merkle_dir, filename)
+        if not os.path.exists(leaves_path):
+            return None
+        stat = os.stat(os.path.join(self.storage_dir, filename))
+        with open(leaves_path, "rb") as f:
+            header = MERKLE_HEADER.unpack(f.read(MERKLE_HEADER.size))
+            if header[0] != chunk_size:
+                return None
+            if check_fresh and header[1:] != (stat.st_mtime_ns, stat.st_size):
+                return None
+            return read_leaves(f)
+
+    def build_merkle_tree(self, filename, chunk_size):
+        """Hash a stored file into Merkle leaves so it can answer Merkle challenges."""
+        filepath = os.path.join(self.storage_dir, filename)
         if not os.path.exists(filepath):
             raise FileNotFoundError(f"File {filename} not found in cloud storage")
+        self._save_leaves(filename, chunk_size, compute_file_leaves(filepath, chunk_size))
+        return True
+
+    def challenge_merkle(self, filename, chunk_size, index):
+        """
+        Respond to a Merkle challenge with one chunk of the file and the
+        authentication path from its leaf to the root.
+        """
+        filepath = os.path.join(self.storage_dir, filename)
+        if not os.path.exists(filepath):
+            raise FileNotFoundError(f"File {filename} not found in cloud storage")
+
+        stat = os.stat(filepath)
+        key = (chunk_size, stat.st_mtime_ns, stat.st_size)
+        cached = self._merkle_levels.get(filename)
+        if cached is None or cached[0] != key:
+            leaves = self._load_leaves(filename, chunk_size)
+            if leaves is None:
+                # The tree is missing or outdated, rebuild it from the stored file
+                self.build_merkle_tree(filename, chunk_size)
+                leaves = self._load_leaves(filename, chunk_size)
+            cached = (key, build_levels(leaves))
+            self._merkle_levels[filename] = cached
+        levels = cached[1]
 
         with open(filepath, "rb") as f:
-            file_content = f.read()
+            f.seek(index * chunk_size)
+            chunk = f.read(chunk_size)
+        path = auth_path(levels, index) if index < len(levels[0]) else []
+        return chunk, path
+
+    def write_chunks(self, filename, chunk_size, chunks, size):
+        """
+        Update a stored file in place.
+        Writes the given {index: chunk} mapping, truncates the file to size
+        and updates only the Merkle leaves of the changed chunks.
+        """
+        filepath = os.path.join(self.storage_dir, filename)
+        if not os.path.exists(filepath):
+            raise FileNotFoundError(f"File {filename} not found in cloud storage")
+
+        leaves = self._load_leaves(filename, chunk_size, check_fresh=False)
+        if leaves is None:
+            leaves = compute_file_leaves(filepath, chunk_size)
+
+        self._forget_responses(filename)
+        with open(filepath, "r+b") as f:
+            for index, chunk in chunks.items():
+                f.seek(index * chunk_size)
+                f.write(chunk)
+            f.truncate(size)
+
+        num_leaves = -(-size // chunk_size)
+        leaves = leaves[:num_leaves]
+        leaves += [None] * (num_leaves - len(leaves))
+        for index, chunk in chunks.items():
+            if index < num_leaves:
+                leaves[index] = leaf_hash(chunk)
+        if None in leaves:
+            # Chunks missing from the update, rebuild from the stored file
+            leaves = compute_file_leaves(filepath, chunk_size)
+        self._save_leaves(filename, chunk_size, leaves)
+        return True
+
+    def challenge(self, filename, nonce, mac=DEFAULT_MAC):
+        """
+        Respond to an integrity challenge by:
+        1. Retrieving the file
+        2. Returning the cached response if the same nonce was already
+           answered for the current version of the file
+        3. Otherwise computing the MAC with the provided nonce and algorithm
+        4. Returning the hash
+        """
+        filepath = os.path.join(self.storage_dir, filename)
+
+        try:
+            key = self._response_key(filename, os.stat(filepath), nonce, mac)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"File {filename} not found in cloud storage")
+
+        response = self._cached_response(key)
+        if response is None:
+            # Hash straight from a memory map of the file, without copying it
+            with metrics.timer("cloud_challenge_hash"):
+                (response,) = compute_file_hmacs_mapped(
+                    filepath, [nonce], algorithm=mac
+                )
+            metrics.inc("cloud_bytes_hashed", key[2])
+            self._cache_response(key, response)
 
         # Store this challenge response for potential replay attacks
-        response = compute_hmac(file_content, nonce)
         self.stored_challenges[filename] = {"nonce": nonce, "response": response}
 
-        # Compute HMAC using the challenge nonce
         return response
 
-    def malicious_challenge(self, filename, nonce):
+    def challenge_batch(self, items):
+        """
+        Respond to several integrity challenges at once.
+        1. Group the (filename, nonce) or (filename, nonce, mac) items by file
+        2. Answer the nonces found in the response cache
+        3. Read the files in on-disk order (by device and inode), streaming
+           each file once per MAC algorithm for all of its remaining nonces
+        4. Return the hashes in the order of the request, with None for
+           files that are not in cloud storage
+        """
+        nonces_by_file = {}
+        for index, (filename, nonce, *mac) in enumerate(items):
+            mac = mac[0] if mac else DEFAULT_MAC
+            nonces_by_file.setdefault(filename, []).append((index, nonce, mac))
+
+        located = []
+        for filename in nonces_by_file:
+            try:
+                stat = os.stat(os.path.join(self.storage_dir, filename))
+            except FileNotFoundError:
+                continue
+            located.append(((stat.st_dev, stat.st_ino), filename, stat))
+
+        responses = [None] * len(items)
+        for _, filename, stat in sorted(located, key=lambda item: item[0]):
+            requests_by_mac = {}
+            for index, nonce, mac in nonces_by_file[filename]:
+                key = self._response_key(filename, stat, nonce, mac)
+                response = self._cached_response(key)
+                if response is None:
+                    requests_by_mac.setdefault(mac, []).append((index, nonce, key))
+                else:
+                    responses[index] = response
+
+            filepath = os.path.join(self.storage_dir, filename)
+            try:
+                for mac, requests in requests_by_mac.items():
+                    with metrics.timer("cloud_challenge_hash"):
+                        hashes = compute_file_hmacs_mapped(
+                            filepath, [n for _, n, _ in requests], algorithm=mac
+                        )
+                    metrics.inc("cloud_bytes_hashed", stat.st_size)
+                    for (index, nonce, key), response in zip(requests, hashes):
+                        responses[index] = response
+                        self._cache_response(key, response)
+            except FileNotFoundError:
+                continue
+
+            index, nonce, _ = nonces_by_file[filename][-1]
+            self.stored_challenges[filename] = {
+                "nonce": nonce,
+                "response": responses[index],
+            }
+
+        return responses
+
+    def malicious_challenge(self, filename, nonce, mac=DEFAULT_MAC):
         """
         A malicious version of challenge that always returns a previously computed hash
         regardless of the new nonce. This simulates a replay attack.
@@ -50,4 +352,4 @@ class Cloud:
             return self.stored_challenges[filename]["response"]
         else:
             # If we haven't seen this file before, compute normally but store for future
-            return self.challenge(filename, nonce)
+            return self.challenge(filename, nonce, mac)
@@ -1,9 +1,13 @@
 import os
 import sys
+import atexit
+import asyncio
 import argparse
 import logging
-from client import Client
-from cloud import Cloud
+from client import Client, ChallengesExhaustedError
+from cloud import Cloud, RESPONSE_CACHE_SIZE
+from metrics import metrics
+from utils import DEFAULT_MAC, MAC_ALGORITHMS
 
 # Configure logging
 logging.basicConfig(
@@ -25,11 +29,22 @@ def main():
     parser = argparse.ArgumentParser(description="File integrity verification demo")
     parser.add_argument(
         "--action",
-        choices=["upload", "verify", "demo"],
+        choices=[
+            "upload",
+            "upload-dir",
+            "update",
+            "verify",
+            "verify-all",
+            "serve",
+            "benchmark",
+            "benchmark-mac",
+            "demo",
+        ],
         default="demo",
         help="Action to perform",
     )
     parser.add_argument("--file", help="File to process")
+    parser.add_argument("--dir", help="Directory to process recursively")
     parser.add_argument(
         "--log-level",
         choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
@@ -48,14 +63,150 @@ def main():
         default=10,
         help="Number of precalculated hashes to generate for each file",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads used to compute the precalculated hashes",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Number of challenges issued concurrently by verify-all",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="Number of files challenged per batched request in verify-all",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        help="Enable block mode with blocks of this many bytes (e.g. 4096); "
+        "challenges then sample tagged blocks instead of hashing whole files",
+    )
+    parser.add_argument(
+        "--detection-probability",
+        type=float,
+        default=0.99,
+        help="Probability that a block challenge detects a damaged file",
+    )
+    parser.add_argument(
+        "--corruption-fraction",
+        type=float,
+        default=0.01,
+        help="Fraction of damaged blocks that block challenges must detect",
+    )
+    parser.add_argument(
+        "--merkle-chunk-size",
+        type=int,
+        help="Enable Merkle mode with chunks of this many bytes; files can then "
+        "be updated incrementally and challenges return O(log n) proofs",
+    )
+    parser.add_argument(
+        "--mac",
+        choices=MAC_ALGORITHMS,
+        default=DEFAULT_MAC,
+        help="MAC algorithm of the challenges of newly uploaded files",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Store contents once by SHA-256 and share challenges between "
+        "files with the same content",
+    )
+    parser.add_argument(
+        "--no-local-copy",
+        action="store_true",
+        help="Keep only the precalculated challenges (or Merkle roots) instead "
+        "of a local copy of every file",
+    )
+    parser.add_argument(
+        "--low-water-mark",
+        type=int,
+        help="Refill the precalculated hashes of a file in the background when "
+        "fewer than this many are left",
+    )
+    parser.add_argument(
+        "--replenish-bandwidth",
+        type=float,
+        help="Disk read budget of the background refill in MB/s (unlimited by default)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=RESPONSE_CACHE_SIZE,
+        help="Number of challenge responses cached by the cloud server (0 disables it)",
+    )
+    parser.add_argument(
+        "--cloud",
+        help="Address of a cloud server ('host:port' or 'unix:/path'); "
+        "uses the in-process cloud when omitted",
+    )
+    parser.add_argument(
+        "--listen",
+        default="127.0.0.1:8765",
+        help="Address the cloud server listens on for the serve action",
+    )
+    parser.add_argument(
+        "--metadata-backend",
+        choices=["json", "sqlite"],
+        default="json",
+        help="Storage used for the client metadata",
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=1000,
+        help="Number of files processed between metadata checkpoints",
+    )
+    parser.add_argument(
+        "--benchmark-sizes",
+        help="Comma-separated list of file sizes in MB for benchmarking (e.g., '1,10,100')",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Record per-stage timings and counters and write them on exit to "
+        "this file (JSON if it ends in .json, Prometheus text otherwise)",
+    )
     args = parser.parse_args()
 
     # Set log level based on argument
     logging.getLogger().setLevel(getattr(logging, args.log_level))
 
+    if args.metrics_file:
+        metrics.enable()
+        atexit.register(metrics.write, args.metrics_file)
+
+    if args.action == "serve":
+        from transport import CloudServer
+
+        try:
+            asyncio.run(
+                CloudServer(Cloud(cache_size=args.cache_size), args.listen).serve_forever()
+            )
+        except KeyboardInterrupt:
+            logger.info("🛑 Cloud server stopped")
+        return 0
+
     client = Client(
         num_nonces=args.num_nonces,
         num_precalculated_hashes=args.num_precalculated_hashes,
+        workers=args.workers,
+        metadata_backend=args.metadata_backend,
+        cloud_address=args.cloud,
+        block_size=args.block_size,
+        detection_probability=args.detection_probability,
+        corruption_fraction=args.corruption_fraction,
+        merkle_chunk_size=args.merkle_chunk_size,
+        low_water_mark=args.low_water_mark,
+        dedup=args.dedup,
+        keep_local_copy=not args.no_local_copy,
+        mac_algorithm=args.mac,
+        replenish_bandwidth=(
+            args.replenish_bandwidth * 1024 * 1024 if args.replenish_bandwidth else None
+        ),
     )
 
     if args.action == "upload":
@@ -66,19 +217,100 @@ def main():
         filename = client.process_file(args.file)
         logger.info(f"✅ File {filename} processed and uploaded to mock cloud ☁️")
 
+    elif args.action == "upload-dir":
+        if not args.dir:
+            logger.error("❌ Error: --dir argument is required for upload-dir action")
+            return 1
+
+        filenames = client.process_directory(
+            args.dir, checkpoint_every=args.checkpoint_every
+        )
+        logger.info(
+            f"✅ {len(filenames)} files from {args.dir} processed and uploaded to mock cloud ☁️"
+        )
+        for filename, error in client.failed_files.items():
+            logger.error(f"⚠️ File {filename} could not be processed: {error}")
+
+    elif args.action == "update":
+        if not args.file:
+            logger.error("❌ Error: --file argument is required for update action")
+            return 1
+
+        changed = client.update_file(args.file)
+        logger.info(
+            f"✅ File {os.path.basename(args.file)} updated in mock cloud ☁️ "
+            f"({len(changed)} chunks changed)"
+        )
+
     elif args.action == "verify":
         if not args.file:
             logger.error("❌ Error: --file argument is required for verify action")
             return 1
 
-        filename = os.path.basename(args.file)
-        result = client.verify_file_integrity(filename)
+        filename = args.file
+        if filename not in client.metadata:
+            filename = os.path.basename(args.file)
+        try:
+            result = client.verify_file_integrity(filename)
+        except ChallengesExhaustedError as e:
+            logger.error(f"⚠️ File {filename} could not be verified: {e}")
+            return 1
 
         if result:
             logger.info(f"🟢 File {filename} integrity verification: SUCCESS ✅")
         else:
             logger.error(f"🔴 File {filename} integrity verification: FAILED ❌")
 
+    elif args.action == "verify-all":
+        report = client.verify_all(
+            concurrency=args.concurrency, batch_size=args.batch_size
+        )
+
+        logger.info("📋 Verification summary:")
+        logger.info(
+            f"Files: {report['files']}, passed: {report['passed']} 🟢, "
+            f"failed: {report['failed']} 🔴, errors: {report['errors']} ⚠️"
+        )
+        logger.info(
+            f"Throughput: {report['files_per_second']:.2f} files/s, "
+            f"{report['bytes_per_second'] / (1024 * 1024):.2f} MB/s"
+        )
+        logger.info(
+            f"Latency per file: p50 {report['p50_latency'] * 1000:.2f} ms, "
+            f"p99 {report['p99_latency'] * 1000:.2f} ms"
+        )
+        stats = client._get_cloud().cache_stats()
+        logger.info(
+            f"Cloud response cache: {stats['hits']} hits, {stats['misses']} misses"
+        )
+        for filename in report["failed_files"]:
+            logger.error(f"🔴 File {filename} integrity verification: FAILED ❌")
+        for filename, error in report["error_files"].items():
+            logger.error(f"⚠️ File {filename} could not be verified: {error}")
+
+    elif args.action == "benchmark":
+        from benchmark import benchmark_precalculation
+
+        sizes_mb = None
+        if args.benchmark_sizes:
+            sizes_mb = [float(size) for size in args.benchmark_sizes.split(",")]
+
+        benchmark_precalculation(
+            sizes_mb, args.num_precalculated_hashes, workers=args.workers
+        )
+
+    elif args.action == "benchmark-mac":
+        from benchmark import benchmark_macs
+
+        sizes_mb = None
+        if args.benchmark_sizes:
+            sizes_mb = [float(size) for size in args.benchmark_sizes.split(",")]
+
+        results = benchmark_macs(sizes_mb)
+        for size_mb, throughputs in results.items():
+            fastest = max(throughputs, key=throughputs.get)
+            logger.info(f"🏁 Fastest MAC for {size_mb:g} MB files: {fastest}")
+
     elif args.action == "demo":
         logger.info("=== 🗂️ COMPREHENSIVE FILE INTEGRITY VERIFICATION DEMO 🗂️ ===")
 
@@ -216,6 +448,7 @@ def main():
             except Exception as e:
                 logger.warning(f"Failed to delete file {test_file}: {str(e)}")
 
+    client.close()
     return 0
 
 
@@ -0,0 +1,94 @@
+import hashlib
+from utils import iter_file_chunks
+
+# Domain separation between leaves and internal nodes
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
+HASH_SIZE = 32
+
+
+def leaf_hash(chunk):
+    """Hash of a leaf of the tree (one chunk of the file)."""
+    return hashlib.sha256(LEAF_PREFIX + chunk).digest()
+
+
+def node_hash(left, right):
+    """Hash of an internal node from the hashes of its children."""
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def build_levels(leaves):
+    """
+    Build every level of the tree, from the leaves up to the root.
+    A node without a sibling is promoted unchanged to the next level, so no
+    hash is ever duplicated.
+    """
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+
+def merkle_root(leaves):
+    """Root of the tree over the given leaf hashes (hash of b'' if empty)."""
+    if not leaves:
+        return hashlib.sha256(b"").digest()
+    return build_levels(leaves)[-1][0]
+
+
+def auth_path(levels, index):
+    """Sibling hashes needed to recompute the root from the leaf at index."""
+    path = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            path.append(level[sibling])
+        index //= 2
+    return path
+
+
+def verify_path(root, num_leaves, index, leaf, path):
+    """
+    Check that a leaf is at the given index of a tree with the given root.
+    The side of every sibling is derived from the index and the number of
+    leaves, not taken from the prover, so a leaf cannot be moved.
+    Costs O(log n) hashes.
+    """
+    if not 0 <= index < num_leaves:
+        return False
+
+    node = leaf
+    width = num_leaves
+    siblings = iter(path)
+    while width > 1:
+        sibling = index ^ 1
+        if sibling < width:
+            other = next(siblings, None)
+            if other is None:
+                return False
+            node = node_hash(other, node) if index & 1 else node_hash(node, other)
+        index //= 2
+        width = (width + 1) // 2
+    return next(siblings, None) is None and node == root
+
+
+def compute_file_leaves(filepath, chunk_size):
+    """Hash every fixed-size chunk of a file into a leaf, in a single pass."""
+    with open(filepath, "rb") as f:
+        return [leaf_hash(chunk) for chunk in iter_file_chunks(f, chunk_size)]
+
+
+def read_leaves(f):
+    """Read the leaf hashes stored back to back in an open binary file."""
+    data = f.read()
+    return [data[i : i + HASH_SIZE] for i in range(0, len(data), HASH_SIZE)]
+
+
+def write_leaves(f, leaves):
+    """Write leaf hashes back to back to an open binary file."""
+    for leaf in leaves:
+        f.write(leaf)
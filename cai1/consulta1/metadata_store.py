@@ -0,0 +1,572 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:
+    # No inter-process locking on platforms without fcntl (Windows)
+    fcntl = None
+
+# Fields of a file entry that are not stored in their own SQLite column
+CHALLENGE_FIELDS = ("precalculated_hashes", "used_count")
+FILE_COLUMNS = ("original_path", "local_path", "nonce", "hash")
+
+
+def normalize_entry(entry):
+    """
+    Convert a file entry to the challenge queue format.
+    The precalculated challenges are kept as an ordered list of
+    [nonce_hex, hash_hex] pairs where the first used_count pairs are consumed.
+    Entries written by older versions keep the challenges in a dict plus a
+    list of used nonces, and are reordered so the used ones come first.
+    """
+    precalculated = entry.get("precalculated_hashes", [])
+    if isinstance(precalculated, dict):
+        used = set(entry.pop("used_hashes", []))
+        pairs = [[n, h] for n, h in precalculated.items() if n in used]
+        used_count = len(pairs)
+        pairs += [[n, h] for n, h in precalculated.items() if n not in used]
+        entry["precalculated_hashes"] = pairs
+        entry["used_count"] = used_count
+    entry.setdefault("precalculated_hashes", [])
+    entry.setdefault("used_count", 0)
+    return entry
+
+
+class MetadataStore:
+    """
+    Base class of the metadata backends.
+    Keeps the catalog in memory together with a queue of the unused
+    challenges of every file, so claiming the next challenge is O(1).
+    """
+
+    def __init__(self):
+        self.files = {}
+        self._unused = {}
+        self._lock = threading.Lock()
+
+    def _index(self, filename, entry):
+        """Build the queue of unused challenges of a file entry."""
+        normalize_entry(entry)
+        self._unused[filename] = deque(
+            entry["precalculated_hashes"][entry["used_count"] :]
+        )
+
+    def _pop_unused(self, filename):
+        """Consume the next unused challenge of a file in memory."""
+        unused = self._unused.get(filename)
+        if not unused:
+            return None
+        self.files[filename]["used_count"] += 1
+        return unused.popleft()
+
+    def _append_unused(self, filename, pairs):
+        """Append new challenges to the queue of a file in memory."""
+        self.files[filename]["precalculated_hashes"].extend(pairs)
+        self._unused.setdefault(filename, deque()).extend(pairs)
+
+    def unused_count(self, filename):
+        """Number of precalculated challenges of a file that are still unused."""
+        return len(self._unused.get(filename, ()))
+
+    def flush(self):
+        """Persist any pending change."""
+
+    def close(self):
+        """Release the resources held by the store."""
+
+
+class JSONMetadataStore(MetadataStore):
+    """
+    Metadata backend that keeps the catalog in a JSON snapshot plus an
+    append-only journal of changes.
+    Adding files and claiming challenges append one JSON line to the journal,
+    fsynced in batches, and the journal is periodically compacted into a new
+    snapshot that atomically replaces the old one. Every journal record holds
+    absolute values, so replaying it over a newer snapshot is harmless.
+
+    Several processes can share the store. Every change is made holding an
+    exclusive lock on a lock file, after replaying the records appended by
+    the other processes, so each challenge is claimed exactly once.
+    """
+
+    def __init__(
+        self, path, journal_path=None, sync_every=32, sync_interval=0.5, compact_every=1000
+    ):
+        super().__init__()
+        self.path = path
+        base = os.path.splitext(path)[0]
+        self.journal_path = journal_path or base + ".journal"
+        self.lock_path = base + ".lock"
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+        self._lock_file = None
+        self._journal = None
+        self._reader = None
+        self._offset = 0  # Journal bytes already applied to the catalog
+        self._journal_records = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    @contextmanager
+    def _exclusive(self):
+        """
+        Hold the store lock of this process and of every other process, with
+        the catalog caught up with the journal. Records appended while holding
+        it are flushed to the OS before releasing it, so the other processes
+        read them.
+        """
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                self._catch_up()
+                yield
+            finally:
+                if self._journal is not None:
+                    self._journal.flush()
+                if fcntl is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def load(self):
+        """Load the snapshot from disk if it exists and replay the journal."""
+        if self._lock_file is None:
+            self._lock_file = open(self.lock_path, "a")
+        with self._exclusive():
+            if self._journal_records >= self.compact_every:
+                self._compact()
+        return self.files
+
+    def _reload(self):
+        """Read the snapshot and the whole journal into the catalog in memory."""
+        files = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                files = json.load(f)
+
+        # The catalog is updated in place, callers keep a reference to it
+        self.files.clear()
+        self.files.update(files)
+        for entry in self.files.values():
+            normalize_entry(entry)
+
+        for handle in (self._journal, self._reader):
+            if handle is not None:
+                handle.close()
+        self._journal = open(self.journal_path, "ab")
+        self._reader = open(self.journal_path, "rb")
+        self._offset = 0
+        self._journal_records = 0
+
+        self._replay_journal()
+        self._unused = {}
+        for filename, entry in self.files.items():
+            self._index(filename, entry)
+
+    def _catch_up(self):
+        """
+        Apply the journal records appended by other processes.
+        If the journal was replaced by a compaction, the new snapshot and
+        journal are read from scratch.
+        """
+        try:
+            journal_inode = os.stat(self.journal_path).st_ino
+        except FileNotFoundError:
+            journal_inode = None
+        if self._journal is None or journal_inode != os.fstat(self._journal.fileno()).st_ino:
+            self._reload()
+            return
+
+        for filename in self._replay_journal():
+            if filename in self.files:
+                self._index(filename, self.files[filename])
+
+    def _replay_journal(self):
+        """
+        Apply the journal records past the applied offset to the catalog.
+        A record torn by a crash can only be the last one, and it is cut off
+        so new records are appended after the last complete one.
+        Returns the names of the files that changed.
+        """
+        touched = set()
+        self._reader.seek(self._offset)
+        for line in self._reader:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                break
+            touched.update(self._apply(record))
+            self._journal_records += 1
+            self._offset += len(line)
+
+        if self._offset < os.fstat(self._reader.fileno()).st_size:
+            os.truncate(self.journal_path, self._offset)
+        return touched
+
+    def _apply(self, record):
+        """Apply one journal record to the catalog and return the files it changed."""
+        op = record["op"]
+        if op == "put":
+            for filename, entry in record["files"].items():
+                self.files[filename] = normalize_entry(entry)
+            return record["files"].keys()
+
+        entry = self.files.get(record["file"])
+        if entry is None:
+            return ()
+        if op == "claim":
+            entry["used_count"] = record["used_count"]
+        elif op == "add":
+            del entry["precalculated_hashes"][record["start"] :]
+            entry["precalculated_hashes"].extend(record["pairs"])
+        return (record["file"],)
+
+    def _append(self, record, sync=True):
+        """
+        Append a record to the journal.
+        The journal is fsynced once sync_every records are pending or
+        sync_interval seconds have passed since the last fsync, and it is
+        compacted once it holds compact_every records.
+        """
+        data = (json.dumps(record) + "\n").encode()
+        self._journal.write(data)
+        self._offset += len(data)
+        self._journal_records += 1
+        self._unsynced += 1
+
+        if self._journal_records >= self.compact_every:
+            self._compact()
+        elif sync and (
+            self._unsynced >= self.sync_every
+            or time.monotonic() - self._last_sync >= self.sync_interval
+        ):
+            self._sync()
+
+    def _sync(self):
+        """Flush the journal to stable storage."""
+        if self._journal is None:
+            return
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _replace_file(self, path, content):
+        """
+        Atomically replace a file: the content is written to a temporary
+        file, fsynced and renamed over the old one, so a crash leaves either
+        the old or the new version.
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        fsync_directory(os.path.dirname(os.path.abspath(path)))
+
+    def _compact(self):
+        """
+        Write the whole catalog to a new snapshot and start an empty journal.
+        The journal is replaced by a new file instead of truncated, so other
+        processes notice the compaction and reload the snapshot.
+        """
+        self._replace_file(self.path, json.dumps(self.files))
+        self._replace_file(self.journal_path, "")
+
+        self._journal.close()
+        self._reader.close()
+        self._journal = open(self.journal_path, "ab")
+        self._reader = open(self.journal_path, "rb")
+        self._offset = 0
+        self._journal_records = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def flush(self):
+        """Flush the journal to stable storage."""
+        with self._lock:
+            self._sync()
+
+    def compact(self):
+        """Compact the journal into a new snapshot."""
+        with self._exclusive():
+            self._compact()
+
+    def put_files(self, entries):
+        """Add or replace the entries of several files with a single record."""
+        with self._exclusive():
+            for filename, entry in entries.items():
+                self._index(filename, entry)
+            self.files.update(entries)
+            self._append({"op": "put", "files": entries})
+
+    def add_challenges(self, filename, pairs):
+        """Append new [nonce_hex, hash_hex] challenges to the queue of a file."""
+        with self._exclusive():
+            if filename not in self.files:
+                return False
+            start = len(self.files[filename]["precalculated_hashes"])
+            self._append_unused(filename, pairs)
+            self._append({"op": "add", "file": filename, "start": start, "pairs": pairs})
+        return True
+
+    def claim_challenge(self, filename, defer=False):
+        """
+        Consume the next unused precalculated challenge of a file.
+        Returns the (nonce_hex, hash_hex) pair, or None if all of them are used.
+        Only the consumed offset changes, so the journal record is tiny.
+        With defer=True the record is not fsynced until the next flush().
+        """
+        with self._exclusive():
+            claimed = self._pop_unused(filename)
+            if claimed is not None:
+                used_count = self.files[filename]["used_count"]
+                self._append(
+                    {"op": "claim", "file": filename, "used_count": used_count},
+                    sync=not defer,
+                )
+        return claimed
+
+    def close(self):
+        """Flush and close the journal and the lock file."""
+        with self._lock:
+            if self._journal is not None:
+                self._sync()
+            for handle in (self._journal, self._reader, self._lock_file):
+                if handle is not None:
+                    handle.close()
+            self._journal = self._reader = self._lock_file = None
+
+
+class SQLiteMetadataStore(MetadataStore):
+    """
+    Metadata backend on top of an embedded SQLite database.
+    Files and precalculated challenges live in separate tables, so adding a
+    file only inserts its rows and claiming a challenge is a single indexed
+    UPDATE instead of a rewrite of the whole catalog.
+
+    Several processes can share the database. Changes run in immediate
+    transactions, which take the write lock up front, so each challenge is
+    claimed by exactly one process.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            filename TEXT PRIMARY KEY,
+            original_path TEXT,
+            local_path TEXT,
+            nonce TEXT,
+            hash TEXT,
+            extra TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE TABLE IF NOT EXISTS challenges (
+            filename TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            nonce TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            used INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (filename, seq)
+        );
+        CREATE INDEX IF NOT EXISTS challenges_unused
+            ON challenges (filename, seq) WHERE used = 0;
+    """
+
+    def __init__(self, path, legacy_json_path=None, busy_timeout=30.0):
+        super().__init__()
+        self.path = path
+        is_new = not os.path.exists(path)
+        # Transactions are managed explicitly, waiting up to busy_timeout
+        # seconds for the write lock held by other processes
+        self.conn = sqlite3.connect(
+            path, timeout=busy_timeout, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(self.SCHEMA)
+
+        # Import the catalog of the JSON backend the first time the database is used
+        if is_new and legacy_json_path and (
+            os.path.exists(legacy_json_path)
+            or os.path.exists(os.path.splitext(legacy_json_path)[0] + ".journal")
+        ):
+            migrate_json_to_sqlite(legacy_json_path, self)
+
+    def load(self):
+        """Load the catalog into memory."""
+        self.files = {}
+        for row in self.conn.execute(
+            "SELECT filename, original_path, local_path, nonce, hash, extra FROM files"
+        ):
+            entry = dict(zip(FILE_COLUMNS, row[1:5]))
+            entry.update(json.loads(row[5]))
+            entry["precalculated_hashes"] = []
+            entry["used_count"] = 0
+            self.files[row[0]] = entry
+
+        # Used challenges are listed first so the consumed offset is a prefix
+        for filename, nonce_hex, hash_hex, used in self.conn.execute(
+            "SELECT filename, nonce, hash, used FROM challenges "
+            "ORDER BY filename, used DESC, seq"
+        ):
+            entry = self.files.get(filename)
+            if entry is None:
+                continue
+            entry["precalculated_hashes"].append([nonce_hex, hash_hex])
+            entry["used_count"] += used
+
+        for filename, entry in self.files.items():
+            self._index(filename, entry)
+        return self.files
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Run statements in their own immediate write transaction.
+        The write lock is held only while the statements run, so other
+        processes never wait on work done between two changes.
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+
+    def put_files(self, entries):
+        """Add or replace the entries of several files in a single transaction."""
+        with self._lock, self._transaction():
+            for filename, entry in entries.items():
+                normalize_entry(entry)
+                extra = {
+                    k: v
+                    for k, v in entry.items()
+                    if k not in FILE_COLUMNS and k not in CHALLENGE_FIELDS
+                }
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                    (filename, *(entry.get(k) for k in FILE_COLUMNS), json.dumps(extra)),
+                )
+                self.conn.execute(
+                    "DELETE FROM challenges WHERE filename = ?", (filename,)
+                )
+                used_count = entry["used_count"]
+                self.conn.executemany(
+                    "INSERT INTO challenges VALUES (?, ?, ?, ?, ?)",
+                    (
+                        (filename, seq, nonce_hex, hash_hex, int(seq < used_count))
+                        for seq, (nonce_hex, hash_hex) in enumerate(
+                            entry["precalculated_hashes"]
+                        )
+                    ),
+                )
+        for filename, entry in entries.items():
+            self._index(filename, entry)
+        self.files.update(entries)
+
+    def add_challenges(self, filename, pairs):
+        """Append new [nonce_hex, hash_hex] challenges to the queue of a file."""
+        with self._lock:
+            if filename not in self.files:
+                return False
+            with self._transaction():
+                # Other processes may have added challenges too
+                (first_seq,) = self.conn.execute(
+                    "SELECT COALESCE(MAX(seq) + 1, 0) FROM challenges WHERE filename = ?",
+                    (filename,),
+                ).fetchone()
+                self.conn.executemany(
+                    "INSERT INTO challenges VALUES (?, ?, ?, ?, 0)",
+                    (
+                        (filename, first_seq + i, nonce_hex, hash_hex)
+                        for i, (nonce_hex, hash_hex) in enumerate(pairs)
+                    ),
+                )
+            self._append_unused(filename, pairs)
+        return True
+
+    def claim_challenge(self, filename, defer=False):
+        """
+        Mark the first unused precalculated challenge of a file as used.
+        Returns the (nonce_hex, hash_hex) pair, or None if all of them are used.
+        The claim is a single indexed UPDATE committed right away, whatever
+        defer says: holding the write lock across the challenges of a sweep
+        would block every other process sharing the database.
+        """
+        with self._lock:
+            with self._transaction():
+                row = self.conn.execute(
+                    """
+                    UPDATE challenges SET used = 1
+                    WHERE rowid = (
+                        SELECT rowid FROM challenges
+                        WHERE filename = ? AND used = 0
+                        ORDER BY seq LIMIT 1
+                    )
+                    RETURNING nonce, hash
+                    """,
+                    (filename,),
+                ).fetchone()
+            self._consume_through(filename, row and [row[0], row[1]])
+        if row is None:
+            return None
+        return row[0], row[1]
+
+    def _consume_through(self, filename, claimed):
+        """
+        Bring the queue in memory in line with a claim made in the database.
+        Challenges claimed by other processes come before the claimed one and
+        are consumed too. With no claim, every challenge is used.
+        """
+        unused = self._unused.get(filename)
+        if not unused:
+            return
+        if claimed is None:
+            self.files[filename]["used_count"] += len(unused)
+            unused.clear()
+        elif claimed in unused:
+            while self._pop_unused(filename) != claimed:
+                pass
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self.conn.close()
+
+
+def fsync_directory(path):
+    """Flush a directory entry change, such as a rename, to stable storage."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def migrate_json_to_sqlite(json_path, store):
+    """Import every file entry of the JSON backend (snapshot and journal) into a SQLite store."""
+    json_store = JSONMetadataStore(json_path)
+    entries = json_store.load()
+    json_store.close()
+    store.put_files(entries)
+    return len(entries)
+
+
+def open_metadata_store(storage_dir, backend="json"):
+    """Create the metadata store of a client storage directory."""
+    json_path = os.path.join(storage_dir, "metadata.json")
+    if backend == "json":
+        return JSONMetadataStore(json_path)
+    if backend == "sqlite":
+        return SQLiteMetadataStore(
+            os.path.join(storage_dir, "metadata.db"), legacy_json_path=json_path
+        )
+    raise ValueError(f"Unknown metadata backend: {backend}")
@@ -0,0 +1,163 @@
+import json
+import time
+import bisect
+import threading
+
+# Upper bounds (in seconds) of the buckets of the stage duration histograms
+STAGE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+# Prefix of the exported metric names
+PREFIX = "consulta1"
+
+
+class _NullTimer:
+    """Timer returned while metrics are disabled, it does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _StageTimer:
+    """Context manager that records the duration of a stage."""
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start_time)
+        return False
+
+
+class Metrics:
+    """
+    Registry of stage duration histograms, counters and gauges.
+    It is disabled by default, and while disabled every recording call
+    returns immediately, so the instrumentation costs next to nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def enable(self):
+        """Start recording metrics."""
+        self.enabled = True
+
+    def reset(self):
+        """Drop everything recorded so far."""
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def timer(self, stage):
+        """Context manager timing a stage into its histogram."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, stage)
+
+    def observe(self, stage, seconds):
+        """Record the duration of one run of a stage."""
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = {
+                    "buckets": [0] * (len(STAGE_BUCKETS) + 1),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            histogram["buckets"][bisect.bisect_left(STAGE_BUCKETS, seconds)] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def inc(self, name, amount=1):
+        """Increase a counter."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def register_gauge(self, name, function):
+        """Register a gauge whose value is computed by a function on export."""
+        self._gauges[name] = function
+
+    def snapshot(self):
+        """Return everything recorded so far as a JSON-serializable dict."""
+        gauges = {}
+        for name, function in list(self._gauges.items()):
+            try:
+                gauges[name] = function()
+            except Exception:
+                continue
+
+        with self._lock:
+            stages = {}
+            for stage, histogram in self._histograms.items():
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(
+                    STAGE_BUCKETS + (float("inf"),), histogram["buckets"]
+                ):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                stages[stage] = {
+                    "count": histogram["count"],
+                    "sum": histogram["sum"],
+                    "buckets": buckets,
+                }
+            return {"stages": stages, "counters": dict(self._counters), "gauges": gauges}
+
+    def to_prometheus(self):
+        """Render a snapshot in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+
+        name = f"{PREFIX}_stage_seconds"
+        lines.append(f"# TYPE {name} histogram")
+        for stage, histogram in sorted(snapshot["stages"].items()):
+            for bound, count in histogram["buckets"].items():
+                le = "+Inf" if bound == "inf" else bound
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram["count"]}')
+
+        for counter, value in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE {PREFIX}_{counter}_total counter")
+            lines.append(f"{PREFIX}_{counter}_total {value}")
+
+        for gauge, value in sorted(snapshot["gauges"].items()):
+            lines.append(f"# TYPE {PREFIX}_{gauge} gauge")
+            lines.append(f"{PREFIX}_{gauge} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Export the metrics to a file: a JSON snapshot if the path ends in
+        .json and the Prometheus text format otherwise.
+        """
+        if path.endswith(".json"):
+            content = json.dumps(self.snapshot(), indent=2)
+        else:
+            content = self.to_prometheus()
+        with open(path, "w") as f:
+            f.write(content)
+
+
+# Registry shared by the client and the cloud
+metrics = Metrics()
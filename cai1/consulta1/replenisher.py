@@ -0,0 +1,100 @@
+import queue
+import logging
+import threading
+from utils import (
+    generate_nonce,
+    iter_file_chunks,
+    iter_throttled,
+    compute_hmacs_stream,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Replenisher:
+    """
+    Background worker that refills the precalculated challenges of files.
+    Files are queued when their unused challenges drop below the low-water
+    mark, and a single thread hashes the local copies off the verification
+    path, reading at most bandwidth bytes per second from disk.
+    """
+
+    def __init__(self, client, low_water_mark, batch_size, bandwidth=None):
+        self.client = client
+        self.low_water_mark = low_water_mark
+        self.batch_size = batch_size
+        self.bandwidth = bandwidth
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Start the worker thread and queue every file already below the mark."""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        for filename in list(self.client.metadata):
+            self.check(filename)
+
+    def check(self, filename):
+        """Queue a file for replenishment if it is below the low-water mark."""
+        filename = self.client._challenge_pool(filename)
+        entry = self.client.metadata.get(filename, {})
+        if "block_size" in entry or "merkle_root" in entry:
+            # Block and Merkle challenges do not use precalculated hashes
+            return
+        if entry.get("local_path") is None:
+            return
+        if self.client.store.unused_count(filename) >= self.low_water_mark:
+            return
+        with self._lock:
+            if filename in self._queued:
+                return
+            self._queued.add(filename)
+        self._queue.put(filename)
+
+    def _run(self):
+        """Replenish queued files until stopped."""
+        while True:
+            filename = self._queue.get()
+            if filename is None:
+                break
+            try:
+                self.replenish(filename)
+            except Exception as e:
+                logger.error(f"⚠️ Could not replenish challenges of {filename}: {e}")
+            finally:
+                with self._lock:
+                    self._queued.discard(filename)
+
+    def replenish(self, filename):
+        """
+        Generate a new batch of challenges for a file:
+        1. Generate fresh random nonces
+        2. Hash the local copy once for all of them, throttled to the budget
+        3. Append the new challenges to the queue of the file in the store
+        """
+        entry = self.client.metadata.get(filename)
+        if entry is None:
+            return 0
+
+        nonces = [generate_nonce() for _ in range(self.batch_size)]
+        with open(entry["local_path"], "rb") as f:
+            hashes = compute_hmacs_stream(
+                iter_throttled(iter_file_chunks(f), self.bandwidth),
+                nonces,
+                self.client._file_mac(filename),
+            )
+
+        pairs = [[n.hex(), h.hex()] for n, h in zip(nonces, hashes)]
+        self.client.store.add_challenges(filename, pairs)
+        logger.info(f"♻️ Added {len(pairs)} precalculated hashes for {filename}.")
+        return len(pairs)
+
+    def stop(self):
+        """Finish the queued files and stop the worker thread."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
@@ -0,0 +1,477 @@
+import io
+import os
+import json
+import struct
+import asyncio
+import logging
+import tempfile
+import threading
+import itertools
+from utils import CHUNK_SIZE, DEFAULT_MAC
+
+logger = logging.getLogger(__name__)
+
+# Every message is a 4-byte big-endian header length and a JSON header.
+# Upload requests are followed by "size" bytes of raw file content.
+HEADER_LENGTH = struct.Struct(">I")
+BODY_OPERATIONS = ("upload", "upload_blob", "upload_block_tags", "write_chunks")
+
+# Uploads larger than this are spooled to disk on the server side
+SPOOL_SIZE = 8 * 1024 * 1024
+
+# Directories of the cloud storage that clients cannot name
+RESERVED_NAMES = (".tags", ".merkle", ".blobs")
+
+
+def parse_address(address):
+    """
+    Parse a transport address.
+    Addresses are either "unix:/path/to/socket" or "host:port".
+    """
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:") :]
+    host, _, port = address.rpartition(":")
+    return "tcp", (host or "127.0.0.1", int(port))
+
+
+async def read_header(reader):
+    """Read the JSON header of the next message."""
+    (length,) = HEADER_LENGTH.unpack(await reader.readexactly(HEADER_LENGTH.size))
+    return json.loads(await reader.readexactly(length))
+
+
+def encode_header(header):
+    """Encode a message header with its length prefix."""
+    data = json.dumps(header).encode()
+    return HEADER_LENGTH.pack(len(data)) + data
+
+
+class CloudServer:
+    """
+    Serve a Cloud instance over TCP or a Unix socket.
+    Requests on a connection are handled concurrently and answered as soon as
+    they complete, so clients can pipeline many challenges per connection.
+    """
+
+    def __init__(self, cloud, address):
+        self.cloud = cloud
+        self.address = address
+        self.server = None
+
+    async def start(self):
+        """Start listening on the configured address."""
+        kind, target = parse_address(self.address)
+        if kind == "unix":
+            self.server = await asyncio.start_unix_server(self._handle, path=target)
+        else:
+            self.server = await asyncio.start_server(self._handle, *target)
+        logger.info(f"☁️ Cloud server listening on {self.address}")
+        return self.server
+
+    async def serve_forever(self):
+        """Start the server and serve requests until cancelled."""
+        server = await self.start()
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        """Read the requests of a connection and dispatch them."""
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                try:
+                    header = await read_header(reader)
+                except asyncio.IncompleteReadError:
+                    break
+
+                if header["op"] in BODY_OPERATIONS:
+                    # The body has to be consumed before reading the next request
+                    body = await self._receive_body(reader, header["size"])
+                    task = asyncio.create_task(
+                        self._respond(writer, write_lock, header, body)
+                    )
+                else:
+                    task = asyncio.create_task(
+                        self._respond(writer, write_lock, header)
+                    )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+    async def _receive_body(self, reader, size):
+        """Receive an upload body into a spooled temporary file."""
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        remaining = size
+        while remaining > 0:
+            chunk = await reader.readexactly(min(CHUNK_SIZE, remaining))
+            body.write(chunk)
+            remaining -= len(chunk)
+        body.seek(0)
+        return body
+
+    async def _respond(self, writer, write_lock, header, body=None):
+        """Run one request against the cloud and write its response."""
+        response = {"id": header["id"], "ok": True}
+        try:
+            response.update(await asyncio.to_thread(self._dispatch, header, body))
+        except Exception as e:
+            response = {
+                "id": header["id"],
+                "ok": False,
+                "error_type": type(e).__name__,
+                "error": str(e),
+            }
+        finally:
+            if body is not None:
+                body.close()
+
+        async with write_lock:
+            writer.write(encode_header(response))
+            await writer.drain()
+
+    def _check_filename(self, filename):
+        """
+        Validate a file name sent by a client before it reaches the cloud.
+        Names are relative paths inside the storage directory: absolute paths,
+        empty, "." or ".." components, the cloud's own directories and
+        anything that resolves outside the storage directory are rejected.
+        """
+        if not isinstance(filename, str) or not filename or "\0" in filename:
+            raise ValueError(f"Invalid file name: {filename!r}")
+        parts = filename.replace(os.sep, "/").split("/")
+        if (
+            os.path.isabs(filename)
+            or any(part in ("", ".", "..") for part in parts)
+            or parts[0] in RESERVED_NAMES
+        ):
+            raise ValueError(f"Invalid file name: {filename!r}")
+
+        root = os.path.realpath(self.cloud.storage_dir)
+        path = os.path.realpath(os.path.join(root, *parts))
+        if not path.startswith(root + os.sep):
+            raise ValueError(f"Invalid file name: {filename!r}")
+        return "/".join(parts)
+
+    def _dispatch(self, header, body):
+        """Call the Cloud method matching a request."""
+        op = header["op"]
+        # Blob uploads carry no file name, their target is checked by BlobStore
+        if "filename" in header and op != "upload_blob":
+            header["filename"] = self._check_filename(header["filename"])
+        if op == "upload":
+            self.cloud.upload_file(header["filename"], body)
+            return {}
+        if op == "upload_blob":
+            self.cloud.upload_blob(header["blob_id"], body)
+            return {}
+        if op == "link_blob":
+            return {"linked": self.cloud.link_blob(header["filename"], header["blob_id"])}
+        if op == "upload_block_tags":
+            self.cloud.upload_block_tags(header["filename"], body)
+            return {}
+        if op == "write_chunks":
+            chunks = {
+                index: body.read(length)
+                for index, length in zip(header["indices"], header["lengths"])
+            }
+            self.cloud.write_chunks(
+                header["filename"], header["chunk_size"], chunks, header["file_size"]
+            )
+            return {}
+        if op == "build_merkle_tree":
+            self.cloud.build_merkle_tree(header["filename"], header["chunk_size"])
+            return {}
+        if op == "challenge_merkle":
+            chunk, path = self.cloud.challenge_merkle(
+                header["filename"], header["chunk_size"], header["index"]
+            )
+            return {"chunk": chunk.hex(), "path": [node.hex() for node in path]}
+        if op == "challenge_blocks":
+            blocks = self.cloud.challenge_blocks(
+                header["filename"], header["block_size"], header["indices"]
+            )
+            return {"blocks": [[block.hex(), tag.hex()] for block, tag in blocks]}
+        if op == "challenge":
+            digest = self.cloud.challenge(
+                header["filename"],
+                bytes.fromhex(header["nonce"]),
+                header.get("mac", DEFAULT_MAC),
+            )
+            return {"digest": digest.hex()}
+        if op == "challenge_batch":
+            digests = self.cloud.challenge_batch(
+                [
+                    (self._check_filename(filename), bytes.fromhex(nonce), *mac)
+                    for filename, nonce, *mac in header["items"]
+                ]
+            )
+            return {"digests": [d.hex() if d is not None else None for d in digests]}
+        if op == "cache_stats":
+            return {"stats": self.cloud.cache_stats()}
+        raise ValueError(f"Unknown operation: {op}")
+
+
+class _Connection:
+    """A single pipelined connection to a CloudServer."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.write_lock = asyncio.Lock()
+        self.pending = {}
+        self.reader_task = asyncio.create_task(self._read_responses())
+
+    async def _read_responses(self):
+        """Resolve the pending requests as their responses arrive."""
+        try:
+            while True:
+                header = await read_header(self.reader)
+                future = self.pending.pop(header["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(header)
+        except Exception as e:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Connection lost: {e}"))
+            self.pending.clear()
+
+    async def request(self, request_id, header, body_file=None):
+        """Send a request, optionally streaming a body from a file, and await its response."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        async with self.write_lock:
+            self.writer.write(encode_header(header))
+            if body_file is not None:
+                while True:
+                    chunk = await asyncio.to_thread(body_file.read, CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.writer.write(chunk)
+                    await self.writer.drain()
+            await self.writer.drain()
+        return await future
+
+    async def close(self):
+        """Close the connection."""
+        self.reader_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+
+class AsyncCloudClient:
+    """
+    Asyncio client of a CloudServer.
+    Keeps a pool of connections and pipelines requests over them, so hundreds
+    of challenges can be in flight at the same time.
+    """
+
+    def __init__(self, address, pool_size=4):
+        self.address = address
+        self.pool_size = pool_size
+        self.connections = []
+        self._ids = itertools.count()
+
+    async def connect(self):
+        """Open the connection pool."""
+        kind, target = parse_address(self.address)
+        for _ in range(self.pool_size):
+            if kind == "unix":
+                reader, writer = await asyncio.open_unix_connection(target)
+            else:
+                reader, writer = await asyncio.open_connection(*target)
+            self.connections.append(_Connection(reader, writer))
+        return self
+
+    async def close(self):
+        """Close every connection of the pool."""
+        for connection in self.connections:
+            await connection.close()
+        self.connections = []
+
+    async def _request(self, header, body_file=None):
+        """Send a request over the least busy connection and check the response."""
+        connection = min(self.connections, key=lambda c: len(c.pending))
+        request_id = next(self._ids)
+        response = await connection.request(
+            request_id, {"id": request_id, **header}, body_file
+        )
+        if not response["ok"]:
+            if response.get("error_type") == "FileNotFoundError":
+                raise FileNotFoundError(response["error"])
+            raise RuntimeError(f"{response['error_type']}: {response['error']}")
+        return response
+
+    async def upload_file(self, filename, f, size, op="upload", **fields):
+        """Upload the contents of an open binary file."""
+        await self._request(
+            {"op": op, "filename": filename, "size": size, **fields}, f
+        )
+        return True
+
+    async def link_blob(self, filename, blob_id):
+        """Store a file as a name of a blob already stored in the cloud."""
+        response = await self._request(
+            {"op": "link_blob", "filename": filename, "blob_id": blob_id}
+        )
+        return response["linked"]
+
+    async def build_merkle_tree(self, filename, chunk_size):
+        """Ask the cloud to hash a stored file into Merkle leaves."""
+        await self._request(
+            {"op": "build_merkle_tree", "filename": filename, "chunk_size": chunk_size}
+        )
+        return True
+
+    async def challenge_merkle(self, filename, chunk_size, index):
+        """Request one chunk of a file and its Merkle authentication path."""
+        response = await self._request(
+            {
+                "op": "challenge_merkle",
+                "filename": filename,
+                "chunk_size": chunk_size,
+                "index": index,
+            }
+        )
+        return (
+            bytes.fromhex(response["chunk"]),
+            [bytes.fromhex(node) for node in response["path"]],
+        )
+
+    async def challenge_blocks(self, filename, block_size, indices):
+        """Request the given blocks of a file together with their tags."""
+        response = await self._request(
+            {
+                "op": "challenge_blocks",
+                "filename": filename,
+                "block_size": block_size,
+                "indices": indices,
+            }
+        )
+        return [
+            (bytes.fromhex(block), bytes.fromhex(tag))
+            for block, tag in response["blocks"]
+        ]
+
+    async def challenge(self, filename, nonce, mac=DEFAULT_MAC):
+        """Send an integrity challenge for a file and return the digest."""
+        response = await self._request(
+            {"op": "challenge", "filename": filename, "nonce": nonce.hex(), "mac": mac}
+        )
+        return bytes.fromhex(response["digest"])
+
+    async def cache_stats(self):
+        """Hit and miss counters of the response cache of the cloud."""
+        response = await self._request({"op": "cache_stats"})
+        return response["stats"]
+
+    async def challenge_batch(self, items):
+        """
+        Send challenges for several (filename, nonce) or (filename, nonce, mac)
+        items in one request.
+        Returns the digests in the same order, with None for missing files.
+        """
+        response = await self._request(
+            {
+                "op": "challenge_batch",
+                "items": [
+                    [filename, nonce.hex(), *mac] for filename, nonce, *mac in items
+                ],
+            }
+        )
+        return [bytes.fromhex(d) if d is not None else None for d in response["digests"]]
+
+
+class RemoteCloud:
+    """
+    Blocking facade over AsyncCloudClient with the same interface as Cloud.
+    Runs its own event loop in a background thread, so calls made from many
+    threads at once are pipelined over the shared connection pool.
+    """
+
+    def __init__(self, address, pool_size=4):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.client = self._run(AsyncCloudClient(address, pool_size).connect())
+
+    def _run(self, coroutine):
+        """Run a coroutine on the background loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def _upload(self, filename, content, op, **fields):
+        """Upload bytes or the rest of an open binary file with a body operation."""
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            content = io.BytesIO(content)
+        start = content.tell()
+        size = content.seek(0, 2) - start
+        content.seek(start)
+        return self._run(
+            self.client.upload_file(filename, content, size, op, **fields)
+        )
+
+    def upload_file(self, filename, content):
+        """Upload a file given as bytes or as an open binary file."""
+        return self._upload(filename, content, "upload")
+
+    def upload_blob(self, blob_id, content):
+        """Upload a content-addressed blob given as bytes or an open binary file."""
+        return self._upload(None, content, "upload_blob", blob_id=blob_id)
+
+    def link_blob(self, filename, blob_id):
+        """Store a file as a name of a blob already stored in the cloud."""
+        return self._run(self.client.link_blob(filename, blob_id))
+
+    def upload_block_tags(self, filename, content):
+        """Upload the block tags of a file."""
+        return self._upload(filename, content, "upload_block_tags")
+
+    def challenge_blocks(self, filename, block_size, indices):
+        """Request the given blocks of a file together with their tags."""
+        return self._run(self.client.challenge_blocks(filename, block_size, indices))
+
+    def build_merkle_tree(self, filename, chunk_size):
+        """Ask the cloud to hash a stored file into Merkle leaves."""
+        return self._run(self.client.build_merkle_tree(filename, chunk_size))
+
+    def challenge_merkle(self, filename, chunk_size, index):
+        """Request one chunk of a file and its Merkle authentication path."""
+        return self._run(self.client.challenge_merkle(filename, chunk_size, index))
+
+    def write_chunks(self, filename, chunk_size, chunks, size):
+        """Update a stored file in place with the given {index: chunk} mapping."""
+        indices = sorted(chunks)
+        return self._upload(
+            filename,
+            b"".join(chunks[index] for index in indices),
+            "write_chunks",
+            chunk_size=chunk_size,
+            indices=indices,
+            lengths=[len(chunks[index]) for index in indices],
+            file_size=size,
+        )
+
+    def challenge(self, filename, nonce, mac=DEFAULT_MAC):
+        """Send an integrity challenge for a file and return the digest."""
+        return self._run(self.client.challenge(filename, nonce, mac))
+
+    def challenge_batch(self, items):
+        """Send challenges for several (filename, nonce[, mac]) items in one request."""
+        return self._run(self.client.challenge_batch(items))
+
+    def cache_stats(self):
+        """Hit and miss counters of the response cache of the cloud."""
+        return self._run(self.client.cache_stats())
+
+    def close(self):
+        """Close the connections and stop the background loop."""
+        self._run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
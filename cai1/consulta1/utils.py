@@ -1,6 +1,27 @@
 import os
 import hmac
+import math
+import mmap
+import random
+import time
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Use a fixed key for demo purposes (in a real app, this would be a secret)
+HMAC_KEY = b"this_is_a_demo_key_for_hmac_calculation_only"
+
+# MAC algorithms that can be used for the challenges, and the default one.
+# BLAKE2b in keyed mode is a MAC by itself and avoids the two hash passes
+# of the HMAC construction; its digest is 32 bytes like HMAC-SHA256.
+MAC_ALGORITHMS = ("hmac-sha256", "hmac-sha512", "blake2b")
+DEFAULT_MAC = "hmac-sha256"
+
+# Size of the buffers fed to the HMAC when streaming file contents
+CHUNK_SIZE = 1024 * 1024
+
+# Default block size and truncated tag size of the block-based proofs
+BLOCK_SIZE = 4096
+BLOCK_TAG_SIZE = 16
 
 
 def generate_nonce():
@@ -8,23 +29,227 @@ def generate_nonce():
     return os.urandom(16)
 
 
-def compute_hmac(content, nonce):
+def walk_files(root):
+    """Yield the path of every regular file below a directory tree."""
+    for dirpath, _, filenames in os.walk(root):
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if os.path.isfile(path):
+                yield path
+
+
+def iter_file_chunks(f, chunk_size=CHUNK_SIZE):
+    """Yield fixed-size chunks read from an open binary file until EOF."""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def iter_throttled(chunks, bytes_per_second):
     """
-    Compute HMAC of content using the provided nonce.
-    Uses a fixed key for this demo, in a real application this would be secure.
+    Yield the given chunks no faster than bytes_per_second.
+    After every chunk it sleeps until the time budget of the bytes read so
+    far has elapsed. A falsy rate disables the throttling.
     """
-    # Use a fixed key for demo purposes (in a real app, this would be a secret)
-    key = b"this_is_a_demo_key_for_hmac_calculation_only"
+    if not bytes_per_second:
+        yield from chunks
+        return
+
+    start_time = time.monotonic()
+    total = 0
+    for chunk in chunks:
+        yield chunk
+        total += len(chunk)
+        delay = start_time + total / bytes_per_second - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
 
+def new_mac(nonce, algorithm=DEFAULT_MAC):
+    """
+    Create a running MAC keyed with the client key and seeded with a nonce.
+    Every algorithm covers the nonce followed by the data fed to it.
+    """
     # Convert nonce to bytes if it's a hex string
     if isinstance(nonce, str):
         nonce = bytes.fromhex(nonce)
 
-    # Combine nonce with content
-    data = nonce + content
+    if algorithm == "hmac-sha256":
+        return hmac.new(HMAC_KEY, nonce, hashlib.sha256)
+    if algorithm == "hmac-sha512":
+        return hmac.new(HMAC_KEY, nonce, hashlib.sha512)
+    if algorithm == "blake2b":
+        mac = hashlib.blake2b(key=HMAC_KEY, digest_size=32)
+        mac.update(nonce)
+        return mac
+    raise ValueError(f"Unknown MAC algorithm: {algorithm}")
+
+
+def compute_hmac_stream(chunks, nonce, algorithm=DEFAULT_MAC):
+    """
+    Compute HMAC of a stream of buffers using the provided nonce.
+    The nonce is fed first and then every chunk, so memory usage is bounded
+    by the chunk size instead of the total content size.
+    """
+    mac = new_mac(nonce, algorithm)
+    for chunk in chunks:
+        mac.update(chunk)
+    return mac.digest()
+
+
+def compute_hmacs_stream(chunks, nonces, algorithm=DEFAULT_MAC):
+    """
+    Compute the HMAC of a stream of buffers for several nonces in one pass.
+    Every chunk is fed into all the running HMAC states, so the content is
+    read only once regardless of the number of nonces.
+    """
+    macs = [new_mac(nonce, algorithm) for nonce in nonces]
+
+    for chunk in chunks:
+        for mac in macs:
+            mac.update(chunk)
+    return [mac.digest() for mac in macs]
+
+
+def compute_file_hmac(filepath, nonce, chunk_size=CHUNK_SIZE, algorithm=DEFAULT_MAC):
+    """Compute HMAC of a file on disk without loading it fully into memory."""
+    with open(filepath, "rb") as f:
+        return compute_hmac_stream(iter_file_chunks(f, chunk_size), nonce, algorithm)
+
+
+def compute_file_hmacs(filepath, nonces, chunk_size=CHUNK_SIZE, algorithm=DEFAULT_MAC):
+    """Compute HMACs of a file for several nonces reading it from disk once."""
+    with open(filepath, "rb") as f:
+        return compute_hmacs_stream(
+            iter_file_chunks(f, chunk_size), nonces, algorithm
+        )
+
+
+def iter_view_chunks(view, chunk_size=CHUNK_SIZE):
+    """Yield zero-copy slices of a memoryview in fixed-size chunks."""
+    for offset in range(0, len(view), chunk_size):
+        yield view[offset : offset + chunk_size]
+
+
+def compute_file_hmacs_mapped(
+    filepath, nonces, chunk_size=CHUNK_SIZE, algorithm=DEFAULT_MAC
+):
+    """
+    Compute HMACs of a file for several nonces straight from a memory map.
+    The HMAC states are fed memoryview slices of the mapping, so no chunk is
+    ever copied into a bytes object and memory use does not grow with the
+    file, while concurrent readers of the same file share the page cache.
+    """
+    if os.path.getsize(filepath) == 0:
+        # Empty files cannot be mapped
+        return compute_file_hmacs(filepath, nonces, chunk_size, algorithm)
+
+    with open(filepath, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mapped, memoryview(mapped) as view:
+        return compute_hmacs_stream(
+            iter_view_chunks(view, chunk_size), nonces, algorithm
+        )
+
+
+def compute_file_hmacs_parallel(
+    filepath, nonces, workers, chunk_size=CHUNK_SIZE, algorithm=DEFAULT_MAC
+):
+    """
+    Compute HMACs of a file for several nonces using a pool of threads.
+    The nonces are split across the workers and every worker streams the
+    file through a shared memory-mapped view. hashlib releases the GIL while
+    hashing large buffers, so the workers run on all the available cores.
+    """
+    nonces = list(nonces)
+    workers = min(workers, len(nonces))
+    if workers <= 1 or os.path.getsize(filepath) == 0:
+        return compute_file_hmacs(filepath, nonces, chunk_size, algorithm)
+
+    groups = [nonces[i::workers] for i in range(workers)]
+
+    with open(filepath, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mapped, memoryview(mapped) as view:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    compute_hmacs_stream,
+                    iter_view_chunks(view, chunk_size),
+                    group,
+                    algorithm,
+                )
+                for group in groups
+            ]
+            group_digests = [future.result() for future in futures]
+
+    # Restore the original nonce order from the interleaved groups
+    digests = [None] * len(nonces)
+    for i, group in enumerate(group_digests):
+        digests[i::workers] = group
+    return digests
+
+
+def compute_hmac(content, nonce, algorithm=DEFAULT_MAC):
+    """
+    Compute HMAC of content using the provided nonce.
+    Uses a fixed key for this demo, in a real application this would be secure.
+    """
+    return compute_hmac_stream((content,), nonce, algorithm)
+
+
+def compute_block_tag(tag_nonce, index, block, algorithm=DEFAULT_MAC):
+    """
+    Compute the tag of one block of a file.
+    The tag binds the block to its index and to the per-upload tag nonce, so
+    blocks cannot be reordered or replayed from a previous upload.
+    """
+    mac = new_mac(tag_nonce, algorithm)
+    mac.update(index.to_bytes(8, "big"))
+    mac.update(block)
+    return mac.digest()[:BLOCK_TAG_SIZE]
+
+
+def write_file_block_tags(filepath, tag_nonce, block_size, out, algorithm=DEFAULT_MAC):
+    """
+    Split a file into fixed-size blocks and write the tag of every block to
+    an open binary file, in block order. Returns the number of blocks.
+    """
+    num_blocks = 0
+    with open(filepath, "rb") as f:
+        for index, block in enumerate(iter_file_chunks(f, block_size)):
+            out.write(compute_block_tag(tag_nonce, index, block, algorithm))
+            num_blocks += 1
+    return num_blocks
+
+
+def blocks_for_detection(num_blocks, detection_probability, corruption_fraction):
+    """
+    Number of blocks to sample so that, if at least corruption_fraction of the
+    blocks are damaged, a challenge detects it with detection_probability.
+    """
+    if num_blocks == 0:
+        return 0
+    if corruption_fraction >= 1:
+        return 1
+    count = math.log(1 - detection_probability) / math.log(1 - corruption_fraction)
+    return min(num_blocks, max(1, math.ceil(count)))
+
+
+def sample_block_indices(nonce, num_blocks, count):
+    """Derive a sorted random subset of block indices from a challenge nonce."""
+    return sorted(random.Random(nonce).sample(range(num_blocks), count))
+
 
-    # Calculate HMAC
-    return hmac.new(key, data, hashlib.sha256).digest()
+def percentile(values, pct):
+    """Return the nearest-rank percentile of a list of values (0.0 if empty)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
 
 
 def compare_digests(a, b):
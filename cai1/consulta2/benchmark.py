@@ -0,0 +1,87 @@
+import os
+import time
+import random
+import logging
+from utils import generate_keys, decrypt_value, ParallelEncryptor
+
+logger = logging.getLogger(__name__)
+
+# Number of values encrypted when no counts are given
+DEFAULT_COUNTS = [1000, 10000, 100000, 1000000]
+
+
+def default_worker_counts():
+    """Powers of two up to the number of CPUs, plus the number of CPUs itself."""
+    cpus = os.cpu_count() or 1
+    counts = []
+    workers = 1
+    while workers < cpus:
+        counts.append(workers)
+        workers *= 2
+    counts.append(cpus)
+    return counts
+
+
+def benchmark_encryption(counts=None, worker_counts=None, public_key=None):
+    """
+    Benchmark the Paillier encryption throughput against the number of workers.
+    Every batch is encrypted once per worker count with a ParallelEncryptor,
+    and the first ciphertext of each run is decrypted as a sanity check.
+
+    Args:
+        counts (list, optional): Batch sizes. Defaults to DEFAULT_COUNTS
+        worker_counts (list, optional): Numbers of worker processes.
+            Defaults to default_worker_counts()
+        public_key (optional): Key to encrypt with; a new key pair is
+            generated when not given
+
+    Returns:
+        dict: Dictionary mapping batch sizes to {workers: values per second}
+    """
+    if counts is None:
+        counts = DEFAULT_COUNTS
+    if worker_counts is None:
+        worker_counts = default_worker_counts()
+
+    private_key = None
+    if public_key is None:
+        public_key, private_key = generate_keys()
+
+    results = {}
+    logger.info(
+        f"Benchmarking encryption with workers {worker_counts} for counts: {counts}"
+    )
+
+    for count in counts:
+        values = [round(random.uniform(100, 2000), 2) for _ in range(count)]
+        results[count] = {}
+
+        for workers in worker_counts:
+            with ParallelEncryptor(public_key, workers) as encryptor:
+                # Start the pool before timing so the spawn cost is not counted
+                encryptor.encrypt(values[:workers])
+
+                start_time = time.perf_counter()
+                encrypted_values = encryptor.encrypt(values)
+                elapsed = time.perf_counter() - start_time
+
+            if len(encrypted_values) != count:
+                raise RuntimeError("Encryption returned a different number of values")
+            if private_key is not None and count:
+                if decrypt_value(private_key, encrypted_values[0]) != values[0]:
+                    raise RuntimeError("Encryption returned values out of order")
+
+            results[count][workers] = count / elapsed if elapsed else 0.0
+
+        baseline = results[count][worker_counts[0]]
+        logger.info(
+            f"{count} values: "
+            + ", ".join(
+                f"{workers} workers {rate:.1f}/s ({rate / baseline:.2f}x)"
+                if baseline
+                else f"{workers} workers {rate:.1f}/s"
+                for workers, rate in results[count].items()
+            )
+        )
+
+    return results
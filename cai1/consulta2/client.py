@@ -2,8 +2,16 @@ import os
 import json
 import pickle
 import sys
+import time
 import logging
-from utils import generate_keys, encrypt_value, decrypt_value
+import itertools
+from utils import (
+    generate_keys,
+    encrypt_value,
+    encrypt_values,
+    decrypt_value,
+    ParallelEncryptor,
+)
 
 # Configure logger
 logger = logging.getLogger(__name__)
@@ -13,16 +21,43 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 if current_dir not in sys.path:
     sys.path.append(current_dir)
 
+# Number of expenses encrypted and persisted together by register_expenses
+BATCH_SIZE = 1000
+
+# Seconds between the metadata saves of register_expenses. The whole file is
+# rewritten on every save, so saving per batch would make imports quadratic.
+METADATA_CHECKPOINT_INTERVAL = 60
+
 
 class AirlineClient:
-    def __init__(self, storage_dir="airline_storage"):
-        """Initialize the airline client with a storage directory."""
+    def __init__(self, storage_dir="airline_storage", workers=1, obfuscator_pool=0):
+        """
+        Initialize the airline client with a storage directory.
+        With more than one worker, bulk registrations encrypt the expenses
+        and the cloud adds them up in pools of that many processes. With an
+        obfuscator pool size, single registrations encrypt with blinding
+        factors precomputed in the background.
+        """
         self.storage_dir = storage_dir
+        self.workers = workers
         os.makedirs(storage_dir, exist_ok=True)
         self.metadata_file = os.path.join(storage_dir, "metadata.json")
         self.keys_file = os.path.join(storage_dir, "keys.pickle")
         self.metadata = self._load_metadata()
         self.public_key, self.private_key = self._load_or_generate_keys()
+        self._cloud = None
+        self._encryptor = None
+        self._obfuscators = None
+        if obfuscator_pool:
+            # Import obfuscator module here, it is only needed with a pool
+            from obfuscator import ObfuscatorPool
+
+            self._obfuscators = ObfuscatorPool(
+                self.public_key,
+                capacity=obfuscator_pool,
+                low_water_mark=obfuscator_pool // 4,
+            )
+            self._obfuscators.start()
 
     def _load_metadata(self):
         """Load metadata from file if it exists."""
@@ -48,6 +83,49 @@ class AirlineClient:
                 pickle.dump({"public_key": public_key, "private_key": private_key}, f)
             return public_key, private_key
 
+    def _get_cloud(self):
+        """Return the cloud instance, loading its storage only the first time."""
+        if self._cloud is None:
+            # Import cloud module here to avoid circular imports
+            from cloud import Cloud
+
+            self._cloud = Cloud(workers=self.workers)
+        return self._cloud
+
+    def _encrypt_batch(self, values):
+        """Encrypt a batch of values, in parallel when workers are configured."""
+        if self.workers <= 1:
+            return encrypt_values(self.public_key, values)
+        if self._encryptor is None:
+            self._encryptor = ParallelEncryptor(self.public_key, self.workers)
+        return self._encryptor.encrypt(values)
+
+    def _encrypt(self, value):
+        """Encrypt a single value, with a precomputed obfuscator if there is a pool."""
+        if self._obfuscators is None:
+            return encrypt_value(self.public_key, value)
+        return self._obfuscators.encrypt(value)
+
+    def close(self):
+        """Release the encryption workers and the obfuscator pool, if started."""
+        if self._encryptor is not None:
+            self._encryptor.close()
+            self._encryptor = None
+        if self._obfuscators is not None:
+            self._obfuscators.stop()
+            self._obfuscators = None
+
+    def _record_expense(self, passenger_id, year, expense, encrypted_expense):
+        """Record the metadata of an expense in memory."""
+        # Initialize passenger data if not exists
+        if passenger_id not in self.metadata["passengers"]:
+            self.metadata["passengers"][passenger_id] = {}
+
+        self.metadata["passengers"][passenger_id][year] = {
+            "encrypted_expense": str(encrypted_expense),
+            "original_expense": expense,  # For verification purposes only
+        }
+
     def register_passenger_expense(self, passenger_id, year, expense):
         """
         Register a new expense for a passenger.
@@ -56,35 +134,72 @@ class AirlineClient:
         3. Upload encrypted expense to the cloud
         """
         # Encrypt the expense amount
-        encrypted_expense = encrypt_value(self.public_key, expense)
-
-        # Initialize passenger data if not exists
-        if passenger_id not in self.metadata["passengers"]:
-            self.metadata["passengers"][passenger_id] = {}
+        encrypted_expense = self._encrypt(expense)
 
         # Store metadata locally
-        self.metadata["passengers"][passenger_id][year] = {
-            "encrypted_expense": str(encrypted_expense),
-            "original_expense": expense,  # For verification purposes only
-        }
+        self._record_expense(passenger_id, year, expense, encrypted_expense)
         self._save_metadata()
 
-        # Import cloud module here to avoid circular imports
-        from cloud import Cloud
-
-        cloud = Cloud()
+        cloud = self._get_cloud()
         cloud.store_encrypted_expense(passenger_id, year, encrypted_expense)
 
         return True
 
+    def register_expenses(self, expenses, batch_size=BATCH_SIZE):
+        """
+        Register many expenses from an iterable of (passenger_id, year, expense).
+        The iterable is consumed in batches, so it can be a stream of any
+        length. For every batch:
+        1. Encrypt all the expense amounts
+        2. Upload the encrypted expenses to the cloud with a single bulk store
+        3. Record their metadata locally in memory
+        The metadata is saved every METADATA_CHECKPOINT_INTERVAL seconds and
+        once at the end, even if the import fails halfway.
+        Returns the number of expenses registered.
+        """
+        cloud = self._get_cloud()
+        expenses = iter(expenses)
+        total = 0
+        last_save = time.monotonic()
+
+        try:
+            while True:
+                batch = list(itertools.islice(expenses, batch_size))
+                if not batch:
+                    break
+
+                encrypted_expenses = self._encrypt_batch(
+                    [expense for _, _, expense in batch]
+                )
+
+                cloud.store_encrypted_expenses_bulk(
+                    (passenger_id, year, encrypted_expense)
+                    for (passenger_id, year, _), encrypted_expense in zip(
+                        batch, encrypted_expenses
+                    )
+                )
+
+                for (passenger_id, year, expense), encrypted_expense in zip(
+                    batch, encrypted_expenses
+                ):
+                    self._record_expense(passenger_id, year, expense, encrypted_expense)
+
+                total += len(batch)
+                logger.info(f"📦 Registered {total} expenses")
+
+                if time.monotonic() - last_save >= METADATA_CHECKPOINT_INTERVAL:
+                    self._save_metadata()
+                    last_save = time.monotonic()
+        finally:
+            self._save_metadata()
+
+        return total
+
     def request_sum_calculation(self, year):
         """
         Request the cloud to calculate the sum of expenses for a specific year
         """
-        # Import cloud module here to avoid circular imports
-        from cloud import Cloud
-
-        cloud = Cloud()
+        cloud = self._get_cloud()
 
         try:
             # Request cloud to perform the calculation
@@ -113,6 +228,23 @@ class AirlineClient:
             logger.error(f"Error requesting sum calculation: {e}")
             return None
 
+    def request_passenger_sum_calculation(self, passenger_id):
+        """
+        Request the cloud for the sum of the expenses of a passenger over all years
+        """
+        cloud = self._get_cloud()
+
+        encrypted_sum = cloud.calculate_passenger_expenses_sum(passenger_id)
+        if encrypted_sum is None:
+            logger.warning("Encrypted sum is None")
+            return None
+
+        try:
+            return decrypt_value(self.private_key, encrypted_sum)
+        except Exception as e:
+            logger.error(f"Error decrypting sum: {e}")
+            return None
+
     def verify_calculation(self, year):
         """
         Verify that the cloud's calculation matches our local calculation.
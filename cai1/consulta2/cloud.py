@@ -1,15 +1,29 @@
 import os
 import pickle
+from utils import homomorphic_reduce, tree_sum
+
+# Number of appended pickle frames after which the storage files are compacted
+COMPACT_FRAMES = 1000
+
+# Tag of the records with the running totals in the pickle file
+TOTALS_RECORD = "totals"
 
 
 class Cloud:
-    def __init__(self, storage_dir="cloud_storage"):
-        """Initialize the cloud with a storage directory."""
+    def __init__(self, storage_dir="cloud_storage", workers=1):
+        """
+        Initialize the cloud with a storage directory.
+        Sums over many expenses are split across up to workers processes.
+        """
         self.storage_dir = storage_dir
+        self.workers = workers
         os.makedirs(storage_dir, exist_ok=True)
         self.data_file = os.path.join(storage_dir, "encrypted_data.txt")
         self.pickle_file = os.path.join(storage_dir, "encrypted_objects.pickle")
         self._encrypted_objects = {}  # In-memory storage for encrypted objects
+        self._frames = 0  # Number of pickle frames in the pickle file
+        self._year_totals = {}  # Running encrypted sum of every year
+        self._passenger_totals = {}  # Running encrypted sum of every passenger
         self.data = self._load_data()
         self._load_encrypted_objects()
 
@@ -37,13 +51,90 @@ class Cloud:
         return data_dict
 
     def _load_encrypted_objects(self):
-        """Load encrypted objects from pickle file."""
-        if os.path.exists(self.pickle_file):
-            try:
-                with open(self.pickle_file, "rb") as f:
-                    self._encrypted_objects = pickle.load(f)
-            except Exception as e:
-                print(f"Error loading encrypted objects: {e}")
+        """
+        Load encrypted objects from pickle file.
+        The file is a sequence of pickled dicts, the first one written by a
+        full save and the rest appended by stores, so they are merged in
+        order and later entries win. A frame torn by a crash during an append
+        is cut off the end of the file. Every dict is followed by a record with
+        the running totals it changed. If one is missing (storage written
+        before the totals existed) or a torn frame was cut off, the totals
+        are rebuilt from the encrypted objects.
+        """
+        if not os.path.exists(self.pickle_file):
+            return
+
+        totals_missing = False
+        try:
+            with open(self.pickle_file, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                offset = 0  # End of the last complete frame
+                pending = False
+                while offset < size:
+                    try:
+                        frame = pickle.load(f)
+                    except Exception:
+                        # A frame torn by a crash can only be the last one
+                        break
+                    offset = f.tell()
+                    if isinstance(frame, tuple) and frame[0] == TOTALS_RECORD:
+                        self._year_totals.update(frame[1])
+                        self._passenger_totals.update(frame[2])
+                        pending = False
+                        continue
+                    totals_missing = totals_missing or pending
+                    self._encrypted_objects.update(frame)
+                    self._frames += 1
+                    pending = True
+                totals_missing = totals_missing or pending
+
+            # Cut the torn frame off so new frames follow the last complete one.
+            # The totals are rebuilt since the cut may have left a dict
+            # without the totals record written after it.
+            if offset < size:
+                print(f"Warning: Discarding torn data at the end of {self.pickle_file}")
+                os.truncate(self.pickle_file, offset)
+                totals_missing = True
+        except Exception as e:
+            print(f"Error loading encrypted objects: {e}")
+            return
+
+        if totals_missing:
+            self._rebuild_totals()
+            self._save_data()
+
+    def _rebuild_totals(self):
+        """Recompute every running total from the stored encrypted expenses."""
+        self._year_totals = {}
+        self._passenger_totals = {}
+        by_passenger = {}
+
+        for year, passengers in self.data.items():
+            encrypted_expenses = []
+            for passenger_id in passengers:
+                encrypted_expense = self._encrypted_objects.get(f"{year}:{passenger_id}")
+                if encrypted_expense is None:
+                    continue
+                encrypted_expenses.append(encrypted_expense)
+                by_passenger.setdefault(passenger_id, []).append(encrypted_expense)
+            if encrypted_expenses:
+                self._year_totals[year] = homomorphic_reduce(
+                    encrypted_expenses, self.workers
+                )
+
+        for passenger_id, encrypted_expenses in by_passenger.items():
+            self._passenger_totals[passenger_id] = tree_sum(encrypted_expenses)
+
+    def _totals_record(self, years, passenger_ids):
+        """Build the pickle record with the running totals of some years and passengers."""
+        return (
+            TOTALS_RECORD,
+            {year: self._year_totals[year] for year in years},
+            {
+                passenger_id: self._passenger_totals[passenger_id]
+                for passenger_id in passenger_ids
+            },
+        )
 
     def _save_data(self):
         """Save data to file in text format."""
@@ -56,21 +147,65 @@ class Cloud:
                             f"{year}:{passenger_id}:{id(self._encrypted_objects.get(f'{year}:{passenger_id}'))}\n"
                         )
 
-            # Save actual encrypted objects to pickle file
+            # Save actual encrypted objects to pickle file, then the totals
             with open(self.pickle_file, "wb") as f:
                 pickle.dump(self._encrypted_objects, f)
+                pickle.dump(
+                    self._totals_record(self._year_totals, self._passenger_totals), f
+                )
+            self._frames = 1
         except Exception as e:
             print(f"Error saving data: {e}")
 
-    def store_encrypted_expense(self, passenger_id, year, encrypted_expense):
+    def _append_data(self, keys, years, passenger_ids):
         """
-        Store an encrypted expense in the cloud.
+        Append the given entries to the files on disk.
+        Only the new references, one pickle frame with the new objects and
+        the totals of the given years and passengers are written, so
+        persisting a batch does not rewrite the whole storage.
+        """
+        try:
+            with open(self.data_file, "a") as f:
+                for key in keys:
+                    f.write(f"{key}:{id(self._encrypted_objects.get(key))}\n")
+
+            with open(self.pickle_file, "ab") as f:
+                pickle.dump({key: self._encrypted_objects[key] for key in keys}, f)
+                pickle.dump(self._totals_record(years, passenger_ids), f)
+            self._frames += 1
+        except Exception as e:
+            print(f"Error saving data: {e}")
+            return
+
+        # Fold the appended frames back into a single one now and then
+        if self._frames > COMPACT_FRAMES:
+            self._save_data()
+
+    def _add_to_total(self, totals, name, encrypted_expense, old_expense):
+        """
+        Add an expense to a running total, replacing the old expense it
+        overwrites if there is one.
+        """
+        total = totals.get(name)
+        if total is not None and old_expense is not None:
+            total = total - old_expense
+
+        if total is None:
+            totals[name] = encrypted_expense
+        else:
+            totals[name] = self.sumaGastos(total, encrypted_expense)
+
+    def _store(self, passenger_id, year, encrypted_expense):
+        """
+        Store an encrypted expense in memory and update the running totals
+        of its year and passenger, in constant time. Returns the reference key.
         """
         if year not in self.data:
             self.data[year] = {}
 
         # Create a reference key
         key = f"{year}:{passenger_id}"
+        old_expense = self._encrypted_objects.get(key)
 
         # Store the reference in the data dictionary
         self.data[year][passenger_id] = key
@@ -78,41 +213,54 @@ class Cloud:
         # Store the actual encrypted object in our in-memory dictionary
         self._encrypted_objects[key] = encrypted_expense
 
+        self._add_to_total(self._year_totals, year, encrypted_expense, old_expense)
+        self._add_to_total(
+            self._passenger_totals, passenger_id, encrypted_expense, old_expense
+        )
+        return key
+
+    def store_encrypted_expense(self, passenger_id, year, encrypted_expense):
+        """
+        Store an encrypted expense in the cloud.
+        """
+        key = self._store(passenger_id, year, encrypted_expense)
+
         # Save both to disk
-        self._save_data()
+        self._append_data([key], [year], [passenger_id])
         return True
 
+    def store_encrypted_expenses_bulk(self, expenses):
+        """
+        Store a batch of encrypted expenses in the cloud.
+        Takes (passenger_id, year, encrypted_expense) tuples and persists the
+        whole batch with a single append to the storage files.
+        """
+        keys = []
+        years = set()
+        passenger_ids = set()
+        for passenger_id, year, encrypted_expense in expenses:
+            keys.append(self._store(passenger_id, year, encrypted_expense))
+            years.add(year)
+            passenger_ids.add(passenger_id)
+
+        if keys:
+            self._append_data(keys, years, passenger_ids)
+        return len(keys)
+
     def calculate_expenses_sum(self, year):
         """
         Calculate the sum of encrypted expenses for a specific year.
-        This is the homomorphic operation that works on encrypted data.
+        This is the homomorphic operation that works on encrypted data. The
+        sum is kept up to date as expenses are stored, so this only looks
+        it up.
         """
         if year not in self.data or not self.data[year]:
             return None
+        return self._year_totals.get(year)
 
-        # Get all passenger IDs for this year
-        passenger_ids = list(self.data[year].keys())
-
-        # Get the first encrypted expense
-        first_key = f"{year}:{passenger_ids[0]}"
-        encrypted_sum = self._encrypted_objects.get(first_key)
-
-        if encrypted_sum is None:
-            print(f"Warning: Could not find encrypted expense for {first_key}")
-            return None
-
-        # Add the remaining expenses
-        for passenger_id in passenger_ids[1:]:
-            key = f"{year}:{passenger_id}"
-            encrypted_expense = self._encrypted_objects.get(key)
-
-            if encrypted_expense is None:
-                print(f"Warning: Could not find encrypted expense for {key}")
-                continue
-
-            encrypted_sum += encrypted_expense
-
-        return encrypted_sum
+    def calculate_passenger_expenses_sum(self, passenger_id):
+        """Return the encrypted sum of the expenses of a passenger over all years."""
+        return self._passenger_totals.get(passenger_id)
 
     def sumaGastos(self, Gastos_Acumulados_Confiden, Gasto_de_Vuelo_Confiden):
         """
@@ -1,9 +1,10 @@
 import os
+import csv
 import sys
 import argparse
 import logging
 import random
-from client import AirlineClient
+from client import AirlineClient, BATCH_SIZE
 
 
 # Configure logging
@@ -22,19 +23,68 @@ if current_dir not in sys.path:
 # Import after path setup
 
 
+def read_expenses_csv(path):
+    """
+    Stream (passenger_id, year, expense) tuples from a CSV file.
+    Rows are read lazily, so files of any size use constant memory. A first
+    row whose expense column is not a number is taken as a header and skipped.
+    """
+    with open(path, newline="") as f:
+        for line_number, row in enumerate(csv.reader(f), start=1):
+            if not row:
+                continue
+            try:
+                passenger_id, year, expense = row
+                expense = float(expense)
+            except ValueError:
+                if line_number == 1:
+                    continue
+                raise ValueError(f"Invalid row at line {line_number}: {row}")
+            yield passenger_id.strip(), year.strip(), expense
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Privacy-preserving expense processing demo"
     )
     parser.add_argument(
         "--action",
-        choices=["register", "calculate", "verify", "demo"],
+        choices=["register", "import", "calculate", "verify", "benchmark", "demo"],
         default="demo",
         help="Action to perform",
     )
     parser.add_argument("--passenger", help="Passenger ID")
     parser.add_argument("--year", help="Year for the expense")
     parser.add_argument("--expense", type=float, help="Expense amount")
+    parser.add_argument(
+        "--csv", help="CSV file with passenger,year,expense rows to import"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        help="Number of expenses encrypted and stored together on import",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes encrypting the expenses on import and adding them up in the cloud",
+    )
+    parser.add_argument(
+        "--obfuscator-pool",
+        type=int,
+        default=0,
+        help="Number of encryption obfuscators precomputed in the background (0 disables)",
+    )
+    parser.add_argument(
+        "--benchmark-counts",
+        help="Comma-separated list of value counts for benchmarking (e.g., '1000,10000')",
+    )
+    parser.add_argument(
+        "--benchmark-workers",
+        help="Comma-separated list of worker counts for benchmarking (e.g., '1,2,4')",
+    )
     parser.add_argument(
         "--log-level",
         choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
@@ -46,7 +96,20 @@ def main():
     # Set log level based on argument
     logging.getLogger().setLevel(getattr(logging, args.log_level))
 
-    client = AirlineClient()
+    if args.action == "benchmark":
+        from benchmark import benchmark_encryption
+
+        counts = None
+        if args.benchmark_counts:
+            counts = [int(count) for count in args.benchmark_counts.split(",")]
+        worker_counts = None
+        if args.benchmark_workers:
+            worker_counts = [int(w) for w in args.benchmark_workers.split(",")]
+
+        benchmark_encryption(counts, worker_counts)
+        return 0
+
+    client = AirlineClient(workers=args.workers, obfuscator_pool=args.obfuscator_pool)
 
     if args.action == "register":
         if not args.passenger or not args.year or args.expense is None:
@@ -65,9 +128,37 @@ def main():
         else:
             logger.error("❌ Failed to register expense")
 
+    elif args.action == "import":
+        if not args.csv:
+            logger.error("❌ Error: --csv argument is required for import action")
+            return 1
+
+        try:
+            count = client.register_expenses(
+                read_expenses_csv(args.csv), batch_size=args.batch_size
+            )
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ Failed to import expenses: {e}")
+            return 1
+        finally:
+            client.close()
+        logger.info(f"✅ Imported {count} expenses from {args.csv}")
+
     elif args.action == "calculate":
+        if not args.year and args.passenger:
+            total = client.request_passenger_sum_calculation(args.passenger)
+            if total is not None:
+                logger.info(f"✅ Total expenses for passenger {args.passenger}: {total}")
+            else:
+                logger.error(
+                    f"❌ Failed to calculate expenses for passenger {args.passenger}"
+                )
+            return 0
+
         if not args.year:
-            logger.error("❌ Error: --year argument is required for calculate action")
+            logger.error(
+                "❌ Error: --year or --passenger argument is required for calculate action"
+            )
             return 1
 
         total = client.request_sum_calculation(args.year)
@@ -203,6 +294,7 @@ def main():
                     if os.path.isfile(file_path):
                         os.remove(file_path)
 
+    client.close()
     return 0
 
 
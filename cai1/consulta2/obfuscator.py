@@ -0,0 +1,108 @@
+import logging
+import threading
+from collections import deque
+from phe import paillier
+
+logger = logging.getLogger(__name__)
+
+# Default number of obfuscators kept precomputed, and the refill watermark
+POOL_CAPACITY = 64
+LOW_WATER_MARK = 16
+
+
+def compute_obfuscator(public_key):
+    """Compute a fresh random blinding factor r^n mod n^2."""
+    r = public_key.get_random_lt_n()
+    return pow(r, public_key.n, public_key.nsquare)
+
+
+class ObfuscatorPool:
+    """
+    Bounded buffer of precomputed Paillier obfuscators.
+    Almost all the cost of an encryption is the blinding factor r^n mod n^2,
+    which does not depend on the value, so a background thread computes them
+    ahead of time. Once the buffer drops to the low-water mark it is
+    refilled up to its capacity. Every factor is removed from the buffer when
+    taken, so none is ever used for two ciphertexts.
+    """
+
+    def __init__(self, public_key, capacity=POOL_CAPACITY, low_water_mark=LOW_WATER_MARK):
+        if not 0 <= low_water_mark < capacity:
+            raise ValueError("The low-water mark must be below the capacity")
+        self.public_key = public_key
+        self.capacity = capacity
+        self.low_water_mark = low_water_mark
+        self._factors = deque()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def __len__(self):
+        return len(self._factors)
+
+    def start(self):
+        """Start the background thread, which fills the buffer right away."""
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def fill(self):
+        """Fill the buffer up to its capacity in the calling thread (at idle time)."""
+        while len(self._factors) < self.capacity:
+            factor = compute_obfuscator(self.public_key)
+            with self._condition:
+                self._factors.append(factor)
+
+    def _run(self):
+        """Refill the buffer every time it drops to the low-water mark."""
+        while True:
+            with self._condition:
+                while not self._stopped and len(self._factors) > self.low_water_mark:
+                    self._condition.wait()
+                if self._stopped:
+                    break
+
+            logger.debug(f"🔄 Refilling obfuscator pool from {len(self._factors)}")
+            while not self._stopped and len(self._factors) < self.capacity:
+                factor = compute_obfuscator(self.public_key)
+                with self._condition:
+                    self._factors.append(factor)
+
+    def take(self):
+        """
+        Remove and return one obfuscator. If the buffer is empty the factor
+        is computed on the spot, so callers never wait for the thread.
+        """
+        with self._condition:
+            factor = self._factors.popleft() if self._factors else None
+            if len(self._factors) <= self.low_water_mark:
+                self._condition.notify()
+
+        if factor is None:
+            logger.debug("⚠️ Obfuscator pool empty, computing a factor inline")
+            factor = compute_obfuscator(self.public_key)
+        return factor
+
+    def encrypt(self, value):
+        """
+        Encrypt a numeric value with a precomputed obfuscator.
+        The value is encoded and encrypted without blinding, which with g = n + 1
+        is a single multiplication, and then multiplied by the factor.
+        phe does not know the result is blinded, so exporting it with
+        ciphertext(be_secure=True) would blind it again. That is only slower,
+        and the sums and decryption here read it with be_secure=False.
+        """
+        public_key = self.public_key
+        encoding = paillier.EncodedNumber.encode(public_key, value)
+        ciphertext = public_key.raw_encrypt(encoding.encoding, r_value=1)
+        ciphertext = ciphertext * self.take() % public_key.nsquare
+        return paillier.EncryptedNumber(public_key, ciphertext, encoding.exponent)
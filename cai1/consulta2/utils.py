@@ -1,5 +1,16 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
 from phe import paillier
 
+# Number of values encrypted by a worker process per task
+ENCRYPTION_CHUNK_SIZE = 256
+
+# Minimum number of ciphertexts per worker for a parallel homomorphic sum
+REDUCE_PARTITION_SIZE = 256
+
+# Public key of the current encryption worker process, set by its initializer
+_worker_public_key = None
+
 
 def generate_keys():
     """Generate a pair of public and private keys for homomorphic encryption."""
@@ -12,6 +23,135 @@ def encrypt_value(public_key, value):
     return public_key.encrypt(value)
 
 
+def encrypt_values(public_key, values):
+    """Encrypt a batch of numeric values using the public key, in order."""
+    return [public_key.encrypt(value) for value in values]
+
+
+def _init_encryption_worker(public_key):
+    """Keep the public key in the worker process so tasks do not carry it."""
+    global _worker_public_key
+    _worker_public_key = public_key
+
+
+def _encrypt_chunk(values):
+    """
+    Encrypt a chunk of values in a worker process.
+    The chunk is sent back as a single pickle, which stores the public key
+    shared by all its ciphertexts only once.
+    """
+    return [_worker_public_key.encrypt(value) for value in values]
+
+
+class ParallelEncryptor:
+    """
+    Encrypts batches of values across a pool of worker processes.
+    Paillier encryption is CPU-bound, so the values are split into chunks that
+    the workers encrypt concurrently. The public key is sent once to every
+    worker when the pool starts, and the ciphertexts come back in input order.
+    """
+
+    def __init__(self, public_key, workers=None, chunk_size=ENCRYPTION_CHUNK_SIZE):
+        self.public_key = public_key
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self._executor = None
+
+    def _get_executor(self):
+        """Start the worker pool the first time it is needed."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_encryption_worker,
+                initargs=(self.public_key,),
+            )
+        return self._executor
+
+    def encrypt(self, values):
+        """Encrypt a list of numeric values, returning the ciphertexts in order."""
+        values = list(values)
+        if self.workers <= 1 or len(values) <= 1:
+            return encrypt_values(self.public_key, values)
+
+        # Small batches are spread evenly so that every worker gets a chunk
+        chunk_size = min(self.chunk_size, -(-len(values) // self.workers))
+        chunks = [
+            values[i : i + chunk_size] for i in range(0, len(values), chunk_size)
+        ]
+        encrypted_values = []
+        for encrypted_chunk in self._get_executor().map(_encrypt_chunk, chunks):
+            for encrypted_value in encrypted_chunk:
+                # Share the parent's key instead of one unpickled copy per chunk
+                encrypted_value.public_key = self.public_key
+                encrypted_values.append(encrypted_value)
+        return encrypted_values
+
+    def close(self):
+        """Shut down the worker pool."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def tree_sum(encrypted_values):
+    """
+    Add a list of encrypted values pairwise, level by level, like a binary tree.
+    Returns None for an empty list.
+    """
+    level = list(encrypted_values)
+    if not level:
+        return None
+    while len(level) > 1:
+        paired = [level[i] + level[i + 1] for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+    return level[0]
+
+
+def _sum_partition(encrypted_values):
+    """Add one partition of encrypted values in a worker process."""
+    partial_sum = encrypted_values[0]
+    for encrypted_value in encrypted_values[1:]:
+        partial_sum += encrypted_value
+    return partial_sum
+
+
+def homomorphic_reduce(
+    encrypted_values, workers=None, partition_size=REDUCE_PARTITION_SIZE
+):
+    """
+    Add a list of encrypted values across a pool of worker processes.
+    1. Split the values into one contiguous partition per worker
+    2. Sum every partition homomorphically in its own process
+    3. Combine the partial sums pairwise in a tree
+    Lists too small to give every worker partition_size values use fewer
+    workers, down to a plain sum in the calling process. Returns None for
+    an empty list.
+    """
+    encrypted_values = list(encrypted_values)
+    workers = workers or os.cpu_count() or 1
+    workers = max(1, min(workers, len(encrypted_values) // partition_size))
+    if workers <= 1:
+        return tree_sum(encrypted_values)
+
+    size = -(-len(encrypted_values) // workers)
+    partitions = [
+        encrypted_values[i : i + size]
+        for i in range(0, len(encrypted_values), size)
+    ]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        partial_sums = list(executor.map(_sum_partition, partitions))
+    return tree_sum(partial_sums)
+
+
 def decrypt_value(private_key, encrypted_value):
     """Decrypt an encrypted value using the private key."""
     return private_key.decrypt(encrypted_value)